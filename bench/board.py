@@ -0,0 +1,56 @@
+""" Builds a realistic, fully loaded departure board in memory, for
+benchmarks that don't need a database.
+"""
+import datetime
+import decimal
+import itertools
+
+from jr import model
+
+
+def make_board(number_of_planes=3, manifests_per_plane=8, jumpers_per_manifest=16):
+    now = datetime.datetime.now()
+    ids = itertools.count(1)
+
+    def common(obj):
+        obj.insertion_time = now
+        obj.last_modified = now
+        obj.inserted_by = 'hfl'
+        obj.updated_by = ''
+        return obj
+
+    items = []
+    for item_type, name, price in ((1, '4000 ft', 180), (1, '10000 ft', 250), (3, 'Video', 100), (1, 'Hold', 0)):
+        item = common(model.Item(item_id=next(ids), name=name, price=decimal.Decimal(price), category_id=1))
+        item._item_type = item_type
+        items.append(item)
+
+    planes = []
+    for plane_number in range(number_of_planes):
+        plane = common(model.Plane(plane_id=plane_number + 1, name='LN-%i' % plane_number, capacity=jumpers_per_manifest,
+                                   cycle_time=25, is_active=True))
+        plane.manifests = []
+        planes.append(plane)
+
+        for load_number in range(manifests_per_plane):
+            manifest = common(model.Manifest(manifest_id=next(ids), load_number=load_number + 1, departure=now,
+                                             capacity=plane.capacity, cycle_time=plane.cycle_time))
+            manifest._status = 1
+            manifest.invoices = []
+            plane.manifests.append(manifest)
+
+            for jumper in range(jumpers_per_manifest):
+                customer = common(model.Customer(customer_id=next(ids), name=u'Jumper %i' % jumper,
+                                                 balance=decimal.Decimal('-1234.50'), is_student=False,
+                                                 last_jump=now, waiver_signed=now, reserve_packed=now))
+                customer.data = model.CustomerData(customer_id=customer.customer_id, email='jumper@example.com')
+
+                invoice = common(model.Invoice(invoice_id=next(ids), comment=u'', price=decimal.Decimal(180),
+                                               manual_price=False, quantity=decimal.Decimal(1), machine='NTNUFSKLAP'))
+                invoice.manifest_id = manifest.manifest_id
+                invoice.customer_id = customer.customer_id
+                invoice.customer = customer
+                invoice.item = items[jumper % len(items)]
+                manifest.invoices.append(invoice)
+
+    return planes
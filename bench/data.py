@@ -0,0 +1,228 @@
+""" Fills a database with a synthetic drop zone: tens of thousands of
+jumpers, years of archived loads, invoices and payments, and a busy
+day on the board --- so a boogie weekend can be reproduced locally.
+
+Run from the repository root, with the URL of an empty database:
+
+    python -m bench.data sqlite:///load.sqlite
+    python -m bench.data postgresql://localhost/jr --customers 40000 --years 5
+
+The same seed gives the same data. `bench.load` knows the ids used
+here, so it can be pointed at a site running on the result.
+"""
+import argparse
+import datetime
+import decimal
+import logging
+import random
+import time
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from jr import model
+
+
+logger = logging.getLogger('bench.data')
+
+# (item_id, name, item type, price), with the types of `model.item_types`.
+ITEMS = (
+    (1, '4000 ft', 1, 180),
+    (2, '10000 ft', 1, 250),
+    (3, '13000 ft', 1, 290),
+    (4, 'Tandem', 1, 2500),
+    (5, 'Video', 3, 100),
+    (6, 'Hop n pop', 1, 120),
+    (7, 'Rental rig', 4, 150),
+)
+JUMP_ITEM_IDS = tuple(item_id for item_id, name, item_type, price in ITEMS if item_type == 1)
+
+# (plane_id, name, capacity, cycle time)
+PLANES = (
+    (1, 'LN-NFS', 16, 25),
+    (2, 'LN-FFO', 10, 20),
+    (3, 'LN-OPD', 5, 15),
+)
+
+FIRST_NAMES = (
+    u'Anders', u'Anne', u'Bj\xf8rn', u'Camilla', u'Erik', u'Hilde', u'Ingrid', u'Jon', u'Kari', u'Kristian',
+    u'Lars', u'Line', u'Magnus', u'Marte', u'Nils', u'Ola', u'P\xe5l', u'Ragnhild', u'Silje', u'Tor',
+)
+LAST_NAMES = (
+    u'Andersen', u'Bakken', u'Berg', u'Dahl', u'Eriksen', u'Haugen', u'Hansen', u'Johansen', u'Karlsen', u'Larsen',
+    u'Lie', u'Moen', u'Nilsen', u'Olsen', u'Pedersen', u'Solberg', u'Str\xf8m', u'Tangen', u'\xc5s', u'\xd8deg\xe5rd',
+)
+
+# Rows per INSERT-statement.
+BATCH_SIZE = 5000
+
+
+def get_name(customer_id):
+    """ The name of a generated customer, for `bench.load` to search for. """
+    first_name = FIRST_NAMES[customer_id % len(FIRST_NAMES)]
+    last_name = LAST_NAMES[(customer_id // len(FIRST_NAMES)) % len(LAST_NAMES)]
+    return u'%s %s %i' % (first_name, last_name, customer_id)
+
+
+def get_operating_days(start, end):
+    """ The days of the season we jump: weekends from April through
+    October, and every day in July.
+    """
+    day = start
+    while day < end:
+        if 4 <= day.month <= 10 and (day.weekday() >= 5 or day.month == 7):
+            yield day
+        day += datetime.timedelta(days=1)
+
+
+class Populator(object):
+
+    def __init__(self, engine, number_of_customers=20000, years=3, seed=0):
+        self.engine = engine
+        self.number_of_customers = number_of_customers
+        self.years = years
+        self.random = random.Random(seed)
+
+        self.today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        self.next_manifest_id = 1
+        self.next_invoice_id = 1
+        self.next_payment_id = 1
+
+    def populate(self):
+        model.Base.metadata.create_all(bind=self.engine)
+
+        self.insert(model.SystemConfiguration, [dict(configuration_id=model.BUSINESS_DAY_ID, key='BusinessDay',
+                                                     value=self.today.strftime(model.BUSINESS_DAY_FORMAT))])
+        self.insert(model.Item, [dict(item_id=item_id, name=name, _item_type=item_type, price=decimal.Decimal(price), category_id=1)
+                                 for item_id, name, item_type, price in ITEMS])
+        self.insert(model.Plane, [dict(plane_id=plane_id, name=name, capacity=capacity, cycle_time=cycle_time, is_active=True,
+                                       default_item_id=JUMP_ITEM_IDS[0])
+                                  for plane_id, name, capacity, cycle_time in PLANES])
+
+        self.populate_customers()
+        self.populate_archive()
+        self.populate_today()
+
+    def populate_customers(self):
+        customers, data = [], []
+        for customer_id in range(1, self.number_of_customers + 1):
+            last_jump = self.today - datetime.timedelta(days=self.random.randint(0, self.years * 365))
+            customers.append(dict(
+                customer_id=customer_id, name=get_name(customer_id), balance=decimal.Decimal(self.random.randint(-5000, 500)),
+                is_student=self.random.random() < 0.1, last_jump=last_jump, waiver_signed=last_jump, reserve_packed=last_jump,
+            ))
+            data.append(dict(customer_id=customer_id, email='jumper%i@example.com' % customer_id))
+        self.insert(model.Customer, customers)
+        self.insert(model.CustomerData, data)
+
+    def get_customer_id(self):
+        # A few jump every weekend, most only now and then.
+        return int(self.number_of_customers * self.random.random() ** 3) + 1
+
+    def populate_archive(self):
+        manifests, invoices, payments = [], [], []
+        start = self.today - datetime.timedelta(days=self.years * 365)
+        for day in get_operating_days(start, self.today):
+            for plane_id, name, capacity, cycle_time in PLANES:
+                for load_number in range(1, self.random.randint(2, 16)):
+                    manifest_id = self._allocate('manifest')
+                    manifests.append(self._make_manifest(manifest_id, plane_id, load_number, capacity, cycle_time,
+                                                         day + datetime.timedelta(hours=9, minutes=load_number * cycle_time),
+                                                         status=4, business_date=day))
+                    invoices.extend(self._make_invoices(manifest_id, capacity, business_date=day))
+
+            for i in range(self.random.randint(5, 40)):
+                payments.append(dict(
+                    payment_id=self._allocate('payment'), business_date=day, customer_id=self.get_customer_id(),
+                    amount=decimal.Decimal(self.random.choice((500, 1000, 2000, 5000))), comment=u'',
+                    _transaction_type=1, _method=self.random.randint(1, 3),
+                ))
+
+            if len(invoices) >= BATCH_SIZE:
+                logger.info('Archived up to %s' % day.date())
+                self.insert(model.ArchivedManifest, manifests)
+                self.insert(model.ArchivedInvoice, invoices)
+                self.insert(model.ArchivedPayment, payments)
+                manifests, invoices, payments = [], [], []
+
+        self.insert(model.ArchivedManifest, manifests)
+        self.insert(model.ArchivedInvoice, invoices)
+        self.insert(model.ArchivedPayment, payments)
+
+    def populate_today(self):
+        """ A busy day: the first loads have departed, the next are
+        filling up and the last are empty.
+        """
+        manifests, invoices = [], []
+        for plane_id, name, capacity, cycle_time in PLANES:
+            number_of_loads = self.random.randint(6, 12)
+            for load_number in range(1, number_of_loads + 1):
+                manifest_id = self._allocate('manifest')
+                manifest_invoices = self._make_invoices(manifest_id, capacity * (number_of_loads - load_number) // number_of_loads)
+                manifest = self._make_manifest(manifest_id, plane_id, load_number, capacity, cycle_time,
+                                               self.today + datetime.timedelta(hours=9, minutes=load_number * cycle_time),
+                                               status=3 if load_number <= 2 else 1)
+                manifest['number_of_jumpers'] = sum(1 for invoice in manifest_invoices if invoice['item_id'] in JUMP_ITEM_IDS)
+                manifests.append(manifest)
+                invoices.extend(manifest_invoices)
+
+        self.insert(model.Manifest, manifests)
+        self.insert(model.Invoice, invoices)
+
+    def _make_manifest(self, manifest_id, plane_id, load_number, capacity, cycle_time, departure, status, **kwargs):
+        return dict(kwargs, manifest_id=manifest_id, redundant_key=manifest_id, plane_id=plane_id, load_number=load_number,
+                    capacity=capacity, cycle_time=cycle_time, default_item_id=JUMP_ITEM_IDS[0], departure=departure,
+                    _status=status)
+
+    def _make_invoices(self, manifest_id, number_of_jumpers, **kwargs):
+        invoices = []
+        customer_ids = set(self.get_customer_id() for i in range(number_of_jumpers))
+        for customer_id in customer_ids:
+            item_id = self.random.choice(JUMP_ITEM_IDS)
+            items = [item_id] + ([5] if self.random.random() < 0.05 else [])
+            for item_id in items:
+                invoices.append(dict(
+                    kwargs, invoice_id=self._allocate('invoice'), manifest_id=manifest_id, customer_id=customer_id,
+                    bill_to_id=customer_id, item_id=item_id, price=decimal.Decimal(ITEMS[item_id - 1][3]), comment=u'',
+                ))
+        return invoices
+
+    def _allocate(self, name):
+        attribute = 'next_%s_id' % name
+        id = getattr(self, attribute)
+        setattr(self, attribute, id + 1)
+        return id
+
+    def insert(self, cls, rows):
+        """ Inserts `rows` of attribute values of `cls` with
+        executemany, leaving the rest to the column defaults.
+        """
+        if not rows:
+            return
+        mapper = orm.class_mapper(cls)
+        keys = dict((key, mapper.get_property(key).columns[0].key) for key in rows[0])
+        for i in range(0, len(rows), BATCH_SIZE):
+            self.engine.execute(cls.__table__.insert(), [dict((keys[key], value) for key, value in row.items())
+                                                         for row in rows[i:i + BATCH_SIZE]])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fills a database with a synthetic drop zone.')
+    parser.add_argument('url', help='SQLAlchemy-URL of the (empty) database.')
+    parser.add_argument('--customers', type=int, default=20000, help='Number of customers. (default: 20000)')
+    parser.add_argument('--years', type=int, default=3, help='Years of archived loads. (default: 3)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random data. (default: 0)')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    started_at = time.time()
+    engine = sa.create_engine(options.url)
+    Populator(engine, options.customers, options.years, options.seed).populate()
+    for table in (model.Customer, model.ArchivedManifest, model.ArchivedInvoice, model.ArchivedPayment, model.Manifest, model.Invoice):
+        logger.info('%-8s %8i rows' % (table.__tablename__, engine.execute(sa.select([sa.func.count()]).select_from(table.__table__)).scalar()))
+    logger.info('Done in %.1fs' % (time.time() - started_at))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+""" Drives a running site like a busy boogie weekend, and reports the
+latency percentiles and throughput per endpoint.
+
+Fill a database with `bench.data`, start the site on it, and run from
+the repository root:
+
+    python -m bench.load http://localhost:18080 --users 20 --duration 60
+    python -m bench.load http://localhost:18080 --mix board=20,manifest=3,suggest=5,customer=2
+
+Every virtual user repeatedly picks a scenario by the weights of
+`--mix`:
+
+    board     A viewer polling the board, with If-None-Match.
+    manifest  A manifester adding a jumper to an open load, taking one
+              off again, or adding a load when they're full.
+    suggest   Typing a name into the search, one request per keystroke.
+    customer  Looking up a jumper, their invoices or their stats.
+
+What was sent can be written with `--record` as JSON-lines of
+{"time": ..., "method": ..., "path": ..., "body": ...}, and replayed
+with `--replay`, as fast as the users can, or at the recorded pace
+with `--speed`. Lines without a method and a path are skipped.
+"""
+import argparse
+import collections
+import json
+import random
+import re
+import time
+import urllib
+from cStringIO import StringIO
+
+from twisted.internet import defer, reactor, task
+from twisted.web import client, http_headers
+
+from bench import data
+
+
+SCENARIOS = ('board', 'manifest', 'suggest', 'customer')
+DEFAULT_MIX = 'board=20,manifest=3,suggest=5,customer=2'
+
+
+def percentile(sorted_values, p):
+    """ The nearest-rank `p`-percentile of `sorted_values`. """
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))]
+
+
+def get_endpoint(method, path):
+    """ Names the endpoint of a request: 'GET /api/v0/customers/:id'. """
+    return '%s %s' % (method, re.sub(r'/\d+', '/:id', path.split('?', 1)[0]).rstrip('/'))
+
+
+class Statistics(object):
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.codes = collections.defaultdict(collections.Counter)
+        self.started_at = time.time()
+        self.stopped_at = None
+
+    def add(self, endpoint, code, latency):
+        self.latencies[endpoint].append(latency)
+        self.codes[endpoint][code] += 1
+
+    def stop(self):
+        self.stopped_at = time.time()
+
+    def report(self):
+        duration = (self.stopped_at or time.time()) - self.started_at
+        lines = ['%-44s %8s %8s %8s %8s %8s %8s  %s' % ('endpoint', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'codes')]
+        everything = []
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            everything.extend(latencies)
+            codes = ' '.join('%s:%i' % item for item in sorted(self.codes[endpoint].items()))
+            lines.append(self._format(endpoint, latencies, duration, codes))
+        lines.append(self._format('total', sorted(everything), duration, ''))
+        return '\n'.join(lines)
+
+    def _format(self, endpoint, latencies, duration, codes):
+        return '%-44s %8i %8.1f %8.1f %8.1f %8.1f %8.1f  %s' % (
+            endpoint, len(latencies), len(latencies) / duration,
+            percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000, percentile(latencies, 99) * 1000,
+            (latencies[-1] if latencies else 0) * 1000, codes,
+        )
+
+
+class Client(object):
+    """ Times every request, and records them if asked to. """
+
+    def __init__(self, base_url, statistics, connections, gzip=False, record=None):
+        self.base_url = base_url.rstrip('/')
+        self.statistics = statistics
+        self.record = record
+
+        pool = client.HTTPConnectionPool(reactor)
+        pool.maxPersistentPerHost = connections
+        self.agent = client.Agent(reactor, pool=pool)
+        if gzip:
+            self.agent = client.ContentDecoderAgent(self.agent, [('gzip', client.GzipDecoder)])
+
+    @defer.inlineCallbacks
+    def request(self, method, path, body=None, headers=None):
+        """ Returns (code, headers, body) of the response, with the body
+        decoded if it's JSON. `code` is None if the request failed.
+        """
+        if self.record:
+            self.record.write(json.dumps(dict(time=time.time() - self.statistics.started_at, method=method, path=path, body=body)) + '\n')
+
+        request_headers = http_headers.Headers(dict((key, [value]) for key, value in (headers or dict()).items()))
+        producer = None
+        if body is not None:
+            request_headers.setRawHeaders('Content-Type', ['application/json'])
+            producer = client.FileBodyProducer(StringIO(json.dumps(body)))
+
+        started_at = time.time()
+        try:
+            # Replayed requests are unicode, which the agent won't have.
+            response = yield self.agent.request(str(method), str(self.base_url + path), request_headers, producer)
+            content = yield client.readBody(response)
+        except Exception as e:
+            self.statistics.add(get_endpoint(method, path), type(e).__name__, time.time() - started_at)
+            defer.returnValue((None, None, None))
+
+        self.statistics.add(get_endpoint(method, path), response.code, time.time() - started_at)
+        if content and 'json' in (response.headers.getRawHeaders('Content-Type') or [''])[0]:
+            content = json.loads(content)
+        defer.returnValue((response.code, response.headers, content))
+
+
+class User(object):
+    """ A viewer, manifester and receptionist in one. """
+
+    def __init__(self, client, number_of_customers, rng):
+        self.client = client
+        self.number_of_customers = number_of_customers
+        self.random = rng
+
+        self.etag = None
+        # [(plane_id, manifest_id, number of jumpers, capacity), ...] of the open loads, as of the last board we got.
+        self.loads = []
+        # [(plane_id, manifest_id, customer_id), ...] we've added.
+        self.added = []
+
+    def get_customer_id(self):
+        return self.random.randint(1, self.number_of_customers)
+
+    @defer.inlineCallbacks
+    def board(self):
+        headers = dict()
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        code, response_headers, board = yield self.client.request('GET', '/api/v0/planes', headers=headers)
+        if code != 200:
+            return
+
+        self.etag = response_headers.getRawHeaders('Etag', [None])[0]
+        self.loads = [
+            (plane['plane_id'], manifest['manifest_id'], len(manifest['invoices']), plane['capacity'])
+            for plane in board['planes'] for manifest in plane['manifests'] if manifest['status'] in ('manifest', 'scheduled')
+        ]
+
+    @defer.inlineCallbacks
+    def manifest(self):
+        if not self.loads:
+            yield self.board()
+
+        if self.added and self.random.random() < 0.3:
+            plane_id, manifest_id, customer_id = self.added.pop(self.random.randrange(len(self.added)))
+            yield self.client.request('DELETE', '/api/v0/planes/%i/manifests/%i/%i' % (plane_id, manifest_id, customer_id))
+            return
+
+        open_loads = [load for load in self.loads if load[2] < load[3]]
+        if not open_loads:
+            plane_id = self.random.choice([plane_id for plane_id, name, capacity, cycle_time in data.PLANES])
+            yield self.client.request('POST', '/api/v0/planes/%i/manifests/' % plane_id, dict(plane_id=plane_id))
+            self.loads = []
+            return
+
+        plane_id, manifest_id, number_of_jumpers, capacity = self.random.choice(open_loads)
+        customer_id = self.get_customer_id()
+        code, headers, result = yield self.client.request(
+            'POST', '/api/v0/planes/%i/manifests/%i' % (plane_id, manifest_id),
+            dict(customer_id=customer_id, item_id=self.random.choice(data.JUMP_ITEM_IDS)),
+        )
+        if code == 200:
+            self.added.append((plane_id, manifest_id, customer_id))
+        elif code == 409:
+            # Someone else filled it up.
+            self.loads = []
+
+    @defer.inlineCallbacks
+    def suggest(self):
+        name = data.get_name(self.get_customer_id())
+        for length in range(2, len(name.split()[0]) + 3):
+            yield self.client.request('GET', '/api/v0/suggest?' + urllib.urlencode(dict(q=name[:length].encode('utf8'))))
+
+    @defer.inlineCallbacks
+    def customer(self):
+        path = '/api/v0/customers/%i' % self.get_customer_id()
+        yield self.client.request('GET', path + self.random.choice(('', '/invoices', '/payments', '/stats')))
+
+
+@defer.inlineCallbacks
+def run_users(client, options, mix, rng):
+    scenarios, weights = zip(*mix)
+    deadline = time.time() + options.duration
+
+    @defer.inlineCallbacks
+    def run_user(user):
+        while time.time() < deadline:
+            threshold = rng.random() * sum(weights)
+            for scenario, weight in zip(scenarios, weights):
+                threshold -= weight
+                if threshold < 0:
+                    break
+            yield getattr(user, scenario)()
+
+    yield defer.DeferredList([run_user(User(client, options.customers, random.Random(rng.random()))) for i in range(options.users)])
+
+
+@defer.inlineCallbacks
+def replay(client, options):
+    requests = []
+    skipped = 0
+    with open(options.replay) as f:
+        for line in f:
+            entry = json.loads(line)
+            if 'method' in entry and 'path' in entry:
+                requests.append(entry)
+            else:
+                skipped += 1
+    if skipped:
+        print 'Skipped %i lines without a method and a path' % skipped
+
+    if options.speed:
+        # At the recorded pace, with as many requests in flight as it takes.
+        started_at = time.time()
+        pending = []
+        for entry in requests:
+            delay = entry.get('time', 0) / options.speed - (time.time() - started_at)
+            if delay > 0:
+                yield task.deferLater(reactor, delay, lambda: None)
+            pending.append(client.request(entry['method'], entry['path'], entry.get('body'), entry.get('headers')))
+        yield defer.DeferredList(pending)
+    else:
+        iterator = iter(requests)
+
+        @defer.inlineCallbacks
+        def run_user():
+            for entry in iterator:
+                yield client.request(entry['method'], entry['path'], entry.get('body'), entry.get('headers'))
+
+        yield defer.DeferredList([run_user() for i in range(options.users)])
+
+
+def parse_mix(value):
+    mix = []
+    for part in value.split(','):
+        scenario, weight = part.split('=')
+        if scenario not in SCENARIOS:
+            raise argparse.ArgumentTypeError('unknown scenario %r, expected one of %s' % (scenario, ', '.join(SCENARIOS)))
+        mix.append((scenario, float(weight)))
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-tests a running site, reporting latency percentiles per endpoint.')
+    parser.add_argument('url', help='Where the site runs, e.g. http://localhost:18080')
+    parser.add_argument('-u', '--users', type=int, default=10, help='Number of concurrent users. (default: 10)')
+    parser.add_argument('-d', '--duration', type=float, default=30, help='Seconds to run for. (default: 30)')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help='Weights of the scenarios. (default: %s)' % DEFAULT_MIX)
+    parser.add_argument('--customers', type=int, default=20000, help='Number of customers in the database, from bench.data. (default: 20000)')
+    parser.add_argument('--gzip', action='store_true', help='Accept gzipped responses.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the users. (default: 0)')
+    parser.add_argument('--record', metavar='requests.jsonl', help='Write the requests sent to this file.')
+    parser.add_argument('--replay', metavar='requests.jsonl', help='Send the requests of this file instead of running the scenarios.')
+    parser.add_argument('--speed', type=float, help='Replay at the recorded pace, times this.')
+    options = parser.parse_args()
+
+    statistics = Statistics()
+    record = open(options.record, 'w') if options.record else None
+    load_client = Client(options.url, statistics, options.users, options.gzip, record)
+
+    def run():
+        if options.replay:
+            d = replay(load_client, options)
+        else:
+            d = run_users(load_client, options, options.mix, random.Random(options.seed))
+        d.addBoth(done)
+
+    def done(result):
+        statistics.stop()
+        if record:
+            record.close()
+        print statistics.report()
+        reactor.stop()
+        return result
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
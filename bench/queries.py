@@ -0,0 +1,74 @@
+""" Compares building and compiling the board query for every request,
+as we used to, to the cached query, on a full departure board in an
+in-memory SQLite database.
+
+Run from the repository root:
+
+    python -m bench.queries
+"""
+import timeit
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from jr import manifest, model
+from bench import board
+
+
+def build_board_query(session):
+    """ What we used to do for every request. """
+    return (
+        session.query(model.Plane).outerjoin(model.Manifest).
+        filter(model.Plane.plane_id > 0).
+        filter(model.Plane.is_active == True).
+        options(
+            orm.eagerload_all('manifests.invoices.customer'),
+            *(
+                model.json_only(model.Plane) +
+                model.json_only(model.Manifest, 'manifests') +
+                model.json_only(model.Invoice, 'manifests.invoices') +
+                model.json_only(model.Customer, 'manifests.invoices.customer')
+            )
+        )
+    )
+
+
+def make_database():
+    engine = sa.create_engine('sqlite://')
+    model.Base.metadata.create_all(bind=engine)
+
+    planes = board.make_board()
+    with model.Session(bind=engine) as session:
+        for plane in planes:
+            session.add(plane)
+            for manifest_ in plane.manifests:
+                for invoice in manifest_.invoices:
+                    session.merge(invoice.item)
+        session.commit()
+    return engine
+
+
+def main(number=200):
+    engine = make_database()
+    session = model.Session(bind=engine)
+
+    fresh = lambda: build_board_query(session).all()
+    cached = lambda: manifest._get_board_query(False, False).with_session(session).params(plane_id=None, manifest_id=None).all()
+    assert [plane.plane_id for plane in fresh()] == [plane.plane_id for plane in cached()], 'the queries disagree'
+
+    compile_fresh = lambda: build_board_query(session).statement.compile(dialect=engine.dialect)
+    compile_cached = lambda: manifest._get_board_query(False, False).with_session(session)._compile_context()
+
+    print 'Full board: %i invoices' % session.query(model.Invoice).count()
+    for name, f in (('fresh', fresh), ('cached', cached)):
+        # Load from scratch every time, as a request would.
+        best = min(timeit.repeat(lambda: (session.expunge_all(), f()), number=number // 10, repeat=3)) / (number // 10)
+        print '%-8s %8.2f ms per board query' % (name, best * 1000)
+
+    for name, f in (('fresh', compile_fresh), ('cached', compile_cached)):
+        best = min(timeit.repeat(f, number=number, repeat=3)) / number
+        print '%-8s %8.2f ms building and compiling the query' % (name, best * 1000)
+
+
+if __name__ == '__main__':
+    main()
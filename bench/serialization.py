@@ -0,0 +1,56 @@
+""" Compares the compiled JSON-serializers to the generic
+`__json__`-path they replaced, on a full departure board.
+
+Run from the repository root:
+
+    python -m bench.serialization
+"""
+import json
+import timeit
+
+from jr import base, model
+from bench import board
+
+
+class GenericJSONEncoder(base.JSONEncoder):
+    """ What we used to do: indented output, and checking the
+    instance state of every attribute of every object.
+    """
+
+    def __init__(self, **kw):
+        kw.setdefault('indent', 4)
+        kw.setdefault('separators', (',', ': '))
+        super(GenericJSONEncoder, self).__init__(**kw)
+
+    def default(self, obj):
+        if isinstance(obj, model.Base):
+            if obj not in self._already_visited:
+                self._already_visited.add(obj)
+                keys = obj.json_attributes + obj.json_relations
+            else:
+                keys = obj.json_attributes
+            return dict((key, getattr(obj, key)) for key in keys if obj.is_loaded(key))
+
+        return super(GenericJSONEncoder, self).default(obj)
+
+
+def main(number=20):
+    planes = board.make_board()
+    model.compile_json_serializers()
+
+    generic = GenericJSONEncoder().encode(dict(ok=True, planes=planes))
+    compiled = base.encode_json(dict(ok=True, planes=planes))
+    assert json.loads(generic) == json.loads(compiled), 'the serializers disagree'
+
+    print 'Full board: %i planes, %i manifests, %i invoices' % (
+        len(planes), sum(len(plane.manifests) for plane in planes),
+        sum(len(manifest.invoices) for plane in planes for manifest in plane.manifests)
+    )
+    for name, encode, encoded in (('generic', lambda: GenericJSONEncoder().encode(dict(ok=True, planes=planes)), generic),
+                                  ('compiled', lambda: base.encode_json(dict(ok=True, planes=planes)), compiled)):
+        best = min(timeit.repeat(encode, number=number, repeat=3)) / number
+        print '%-10s %8.2f ms per board, %7i bytes' % (name, best * 1000, len(encoded))
+
+
+if __name__ == '__main__':
+    main()
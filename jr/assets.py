@@ -0,0 +1,259 @@
+""" Building and serving the static assets of the viewers.
+
+In development, the browser compiles the LESS and fetches every
+AMD-module on its own. The build does all of that up front:
+
+    jr-build-assets --public public
+
+It precompiles the Handlebars-templates (in parallel), compiles the
+LESS to CSS, bundles and minifies the RequireJS-graph of every entry
+point together with `main.js`, and writes the results to
+`public/build/` with the hash of their content in their names. The
+HTML-files are copied there too, with the blocks marked by
+`<!-- build:css ... -->` and `<!-- build:js ... -->` pointing to the
+built files instead.
+
+Every built file also gets a gzipped sibling, `<file>.gz`.
+
+`AssetFileHandler` serves the built version of a file if there is
+one, gzipped if the client accepts it, and lets browsers cache the
+hashed files forever. The build needs the node-tools `handlebars`,
+`lessc` and `r.js`.
+"""
+import argparse
+import email.utils
+import gzip
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import time
+from multiprocessing import pool
+
+import cyclone.web
+
+
+logger = logging.getLogger('jr.assets')
+
+BUILD_DIRECTORY = 'build'
+MANIFEST_FILENAME = 'assets.json'
+
+# Loads `main.js`, which loads the sub-module the page names.
+LOADER = 'require-jquery'
+
+HASHED_FILENAME = re.compile(r'\.[0-9a-f]{8}\.\w+$')
+BUILD_BLOCK = re.compile(r'<!-- build:(?P<type>css|js) (?P<name>\S+) -->.*?<!-- endbuild -->', re.DOTALL)
+
+
+def run(command):
+    logger.debug('Running %s' % ' '.join(command))
+    return subprocess.check_output(command)
+
+
+def write_gzipped(filename, content, level=9):
+    """ Writes `content` gzipped to `<filename>.gz`, for
+    `StaticFileHandler` to serve instead of `filename`.
+    """
+    with open(filename + '.gz', 'wb') as f:
+        # Without a timestamp, the same content gives the same file.
+        with gzip.GzipFile(filename=os.path.basename(filename), mode='wb', compresslevel=level, fileobj=f, mtime=0) as compressed:
+            compressed.write(content)
+
+
+def compile_template(filename):
+    """ Precompiles a Handlebars-template to an AMD-module next to it. """
+    output_filename = filename.rsplit('.', 1)[0] + '.template.js'
+    template = run(['handlebars', '-s', filename])
+    with open(output_filename, 'w') as f:
+        f.write("define(['handlebars.vm'], function(Handlebars) { "
+                "return Handlebars.template(%s);"
+                "});" % template)
+    return output_filename
+
+
+class Builder(object):
+
+    def __init__(self, public_directory, jobs=None):
+        self.public_directory = public_directory
+        self.js_directory = os.path.join(public_directory, 'js')
+        self.jobs = jobs or multiprocessing.cpu_count()
+        # What we've built, by the path it's built from: 'js/manifest-viewer.js' -> 'js/manifest-viewer.3fa9c2d1.js'
+        self.assets = dict()
+
+    def build(self):
+        output_directory = os.path.join(self.public_directory, BUILD_DIRECTORY)
+        # Build next to the current build, so it's replaced in one go.
+        self.output_directory = output_directory + '.new'
+        if os.path.exists(self.output_directory):
+            shutil.rmtree(self.output_directory)
+        os.makedirs(self.output_directory)
+
+        self.compile_templates()
+        for filename in self._find_files(self.public_directory, '.html'):
+            self.build_html(filename)
+
+        with open(os.path.join(self.output_directory, MANIFEST_FILENAME), 'w') as f:
+            json.dump(self.assets, f, indent=4, sort_keys=True)
+
+        if os.path.exists(output_directory):
+            shutil.rmtree(output_directory)
+        os.rename(self.output_directory, output_directory)
+        return self.assets
+
+    def compile_templates(self):
+        # The compiler is slow to start, so start several.
+        filenames = list(self._find_files(self.js_directory, '.handlebars'))
+        workers = pool.ThreadPool(self.jobs)
+        try:
+            for output_filename in workers.imap_unordered(compile_template, filenames):
+                logger.info('Compiled %s' % output_filename)
+        finally:
+            workers.close()
+
+    def build_html(self, filename):
+        """ Copies the HTML-file `filename`, with its build-blocks
+        replaced by the built assets they name.
+        """
+        with open(filename) as f:
+            html = f.read()
+
+        def replace(match):
+            if match.group('type') == 'css':
+                return '<link rel="stylesheet" href="%s" type="text/css">' % self.build_less(match.group('name'))
+            return ('<script id="freefly-loader" data-submodule="%s" data-main="%s" src="%s"></script>' %
+                    (match.group('name'), self.build_bundle(match.group('name')), self.build_loader()))
+
+        self._write(os.path.relpath(filename, self.public_directory), BUILD_BLOCK.sub(replace, html), hashed=False)
+
+    def build_less(self, name):
+        """ Compiles `less/<name>.less`, and returns its URL. """
+        return self._build('less/%s.less' % name, lambda path: run(['lessc', '--compress', path]), 'css/%s.css' % name)
+
+    def build_bundle(self, entry_point):
+        """ Bundles `main.js` with `entry_point` and everything it
+        requires, and returns its URL.
+        """
+        return self._build('js/%s.js' % entry_point, lambda path: self._optimize('main', include=entry_point))
+
+    def build_loader(self):
+        return self._build('js/%s.js' % LOADER, lambda path: self._optimize(LOADER))
+
+    def _optimize(self, name, include=None):
+        command = [
+            'r.js', '-o', 'baseUrl=' + self.js_directory, 'mainConfigFile=' + os.path.join(self.js_directory, 'main.js'),
+            'name=' + name, 'optimize=uglify', 'pragmas.buildExclude=true', 'out=stdout', 'logLevel=4',
+        ]
+        if include:
+            command.append('include=' + include)
+        return run(command)
+
+    def _build(self, source, build, target=None):
+        # Several pages may use the same asset.
+        if source not in self.assets:
+            logger.info('Building %s' % source)
+            content = build(os.path.join(self.public_directory, source))
+            self.assets[source] = self._write(target or source, content)
+        return '/%s/%s' % (BUILD_DIRECTORY, self.assets[source])
+
+    def _write(self, path, content, hashed=True):
+        if hashed:
+            base, extension = os.path.splitext(path)
+            path = '%s.%s%s' % (base, hashlib.md5(content).hexdigest()[:8], extension)
+
+        output_filename = os.path.join(self.output_directory, path)
+        if not os.path.exists(os.path.dirname(output_filename)):
+            os.makedirs(os.path.dirname(output_filename))
+        with open(output_filename, 'wb') as f:
+            f.write(content)
+        write_gzipped(output_filename, content)
+        return path
+
+    def _find_files(self, directory, extension):
+        build_directory = os.path.join(self.public_directory, BUILD_DIRECTORY)
+        for path, directories, filenames in os.walk(directory):
+            if path.startswith(build_directory):
+                continue
+            for filename in filenames:
+                if filename.endswith(extension):
+                    yield os.path.join(path, filename)
+
+
+class StaticFileHandler(cyclone.web.StaticFileHandler):
+    """ Serves the gzipped sibling of a file, `<file>.gz`, if there is
+    one and the client accepts it. Subclasses decide how long a file
+    may be cached with `get_max_age`.
+    """
+
+    def get(self, path, include_body=True):
+        self.is_gzipped = False
+        return super(StaticFileHandler, self).get(path, include_body)
+
+    def parse_url_path(self, url_path):
+        path = super(StaticFileHandler, self).parse_url_path(url_path)
+        if 'gzip' in self.request.headers.get('Accept-Encoding', '') and os.path.isfile(os.path.join(self.root, path + '.gz')):
+            self.is_gzipped = True
+            return path + '.gz'
+        return path
+
+    def get_cache_time(self, path, modified, mime_type):
+        if self.is_gzipped:
+            path = path[:-len('.gz')]
+        self.cache_time = self.get_max_age(path)
+        return self.cache_time
+
+    def get_max_age(self, path):
+        return 0
+
+    def set_extra_headers(self, path):
+        self.set_header('Vary', 'Accept-Encoding')
+        if self.is_gzipped:
+            # The Content-Type is guessed from the name without the .gz.
+            self.set_header('Content-Encoding', 'gzip')
+
+        if self.cache_time:
+            # What cyclone sets isn't an HTTP-date.
+            self.set_header('Expires', email.utils.formatdate(time.time() + self.cache_time, usegmt=True))
+        else:
+            self.set_header('Cache-Control', 'no-cache')
+
+
+class AssetFileHandler(StaticFileHandler):
+    """ Serves the built version of a file from `build/` if there is
+    one, and the file itself otherwise. Built files with hashed names
+    never change, so they're cached forever, while everything else
+    must be revalidated.
+    """
+
+    def initialize(self, path, default_filename=None):
+        super(AssetFileHandler, self).initialize(path, default_filename)
+        self.source_root = self.root
+        self.build_root = os.path.join(self.root, BUILD_DIRECTORY) + os.path.sep
+
+    def get(self, path, include_body=True):
+        built_path = os.path.join(self.build_root, cyclone.web.StaticFileHandler.parse_url_path(self, path))
+        if os.path.isdir(built_path) and self.default_filename is not None:
+            built_path = os.path.join(built_path, self.default_filename)
+        self.root = self.build_root if os.path.isfile(built_path) else self.source_root
+        return super(AssetFileHandler, self).get(path, include_body)
+
+    def get_max_age(self, path):
+        return self.CACHE_MAX_AGE if HASHED_FILENAME.search(path) else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds the static assets of the viewers.')
+    parser.add_argument('--public', default='public', help='The directory with the static files. (default: "public")')
+    parser.add_argument('-j', '--jobs', type=int, help='Number of templates to compile at the same time. (default: number of cores)')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    for source, target in sorted(Builder(options.public, options.jobs).build().items()):
+        logger.info('%s -> %s' % (source, target))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 import datetime
 import decimal
+import hashlib
 import json
+import zlib
 
 from cyclone import web
 from piped import util
@@ -10,7 +12,7 @@ from twisted.internet import threads, defer
 import formencode
 import sqlalchemy as sa
 
-from jr import model, exceptions
+from jr import model, profiling, reference, exceptions
 
 
 class JSONEncoder(json.JSONEncoder):
@@ -20,16 +22,22 @@ class JSONEncoder(json.JSONEncoder):
 
     If an object has a `__json__`-method, its result will be used to
     serialize the object --- unless we've already seen it, in which
-    case `__circular_json__` is used.
+    case `__circular_json__` is used. For the model-instances, the
+    serializers compiled by `model.get_json_serializers` are used
+    directly, and the snapshots of `reference.data` are already
+    serialized.
 
     Decimals are returned as integers multipled by 100 by
     default. Pass `decimal_as_multipled_int=False` to return the
     string-representation instead. This is because JavaScript does not
     have a decimal type, and you don't want to use floats. :)
+
+    The output is compact by default. Pass `indent=4` if you're the
+    one reading it.
     """
 
     def __init__(self, **kw):
-        kw.setdefault('indent', 4)
+        kw.setdefault('separators', (',', ':'))
         # Disable the circularity-check, as we do it ourselves below:
         # at least to the extent needed to serialize the
         # model-instances with circular backrefs.
@@ -39,7 +47,18 @@ class JSONEncoder(json.JSONEncoder):
         self._already_visited = set()
 
     def default(self, obj):
-        if hasattr(obj, '__json__'):
+        if isinstance(obj, model.Base):
+            cached = reference.data.get_json(obj)
+            if cached is not None:
+                return cached
+
+            serialize, serialize_circular = model.get_json_serializers(type(obj))
+            if obj not in self._already_visited:
+                self._already_visited.add(obj)
+                return serialize(obj)
+            return serialize_circular(obj)
+
+        elif hasattr(obj, '__json__'):
             if obj not in self._already_visited:
                 self._already_visited.add(obj)
                 return obj.__json__()
@@ -71,10 +90,45 @@ def encode_json(*a, **kw):
     return JSONEncoder().encode(*a, **kw)
 
 
+def gzip_encode(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
 database_dependency_spec = dict(provider='database.engine.jr')
+# The Postgres-mirror of JumpRun, kept up to date by the sync-server.
+mirror_database_dependency_spec = dict(provider='database.engine.mirror')
 
 
 class _DBProcessor(base.Processor):
+    """ Base for processors that use the JumpRun-database.
+
+    Pass `profile: N` to profile the database-work of the next N runs,
+    and `profile_directory` to say where the profiles go.
+    """
+    profiler = None
+
+    def __init__(self, profile=0, profile_directory='profiles', **kw):
+        super(_DBProcessor, self).__init__(**kw)
+        self.runs_to_profile = int(profile)
+        self.profile_directory = profile_directory
+        if self.runs_to_profile:
+            self.process = self._profile_process(self.process)
+
+    def _profile_process(self, process):
+        @defer.inlineCallbacks
+        def wrapper(baton):
+            if self.runs_to_profile <= 0:
+                defer.returnValue((yield process(baton)))
+
+            self.runs_to_profile -= 1
+            self.profiler = profiling.Profile(self.name)
+            try:
+                defer.returnValue((yield process(baton)))
+            finally:
+                profiler, self.profiler = self.profiler, None
+                profiler.save(self.profile_directory)
+        return wrapper
 
     def configure(self, runtime_environment):
         self.engine_dependency = runtime_environment.dependency_manager.add_dependency(self, database_dependency_spec)
@@ -82,15 +136,43 @@ class _DBProcessor(base.Processor):
 
 class Handler(handlers.DebuggableHandler):
     SUPPORTED_METHODS = {"GET", "HEAD", "POST", "DELETE", "PUT", "PATCH"}
+    database_dependency_spec = database_dependency_spec
+    # Set to serve `model.with_read_only_session`-methods from another
+    # database, such as the mirror. See `model.with_session`.
+    read_database_dependency_spec = None
+    # How many seconds behind JumpRun the reads may be. None means any.
+    max_staleness = None
 
     def __init__(self, *args, **kwargs):
         super(Handler, self).__init__(*args, **kwargs)
         # So we don't need the asynchronous decorator all over the place.
         self._auto_finish = False
+        self._etag = None
+        self.statement_stats = model.StatementStats('%s.%s' % (type(self).__name__, self.request.method))
+        self.profiler = None
 
     @classmethod
     def configure(cls, runtime_environment):
-        cls.engine_dependency = runtime_environment.dependency_manager.add_dependency(cls, database_dependency_spec)
+        cls.engine_dependency = runtime_environment.dependency_manager.add_dependency(cls, cls.database_dependency_spec)
+        if cls.read_database_dependency_spec:
+            cls.read_engine_dependency = runtime_environment.dependency_manager.add_dependency(cls, cls.read_database_dependency_spec)
+
+    def prepare(self):
+        super(Handler, self).prepare()
+        # Only for the hosts that may see tracebacks anyway.
+        if self.get_argument('_profile', None) and self.request.remote_ip in self.settings.get('debug_allow', list()):
+            self.profiler = profiling.Profile(self.statement_stats.tag)
+
+    def finish(self, chunk=None):
+        if self.profiler and not self._headers_written:
+            filename = self.profiler.save(self.settings.get('profile_directory', 'profiles'))
+            if filename:
+                self.set_header('X-Profile', filename)
+        return super(Handler, self).finish(chunk)
+
+    def on_finish(self):
+        if self.statement_stats.count:
+            model.record_statement_stats(self.statement_stats)
 
     def get_current_user(self):
         cookie = self.get_secure_cookie('u')
@@ -129,11 +211,89 @@ class Handler(handlers.DebuggableHandler):
 
         return self.get_validated_data(validator, **data)
 
-    def succeed_with_json_and_finish(self, **kwargs):
+    def check_etag(self, *version):
+        """ Sets a strong ETag derived from the requested URI and
+        `version`, which must change whenever the response would.
+
+        Returns True if the client already has that version, in which
+        case the caller should skip the heavy lifting and
+        `finish_not_modified` instead.
+
+        It's fine to call from within `model.with_session`, as are
+        `set_header` and `get_argument`: while the request waits for
+        the worker thread, nothing on the reactor touches the handler,
+        and the headers are only written once the result has been
+        handed back to the reactor, which happens after we're done.
+        """
+        self._etag = '"%s"' % hashlib.sha1(repr((self.request.uri, ) + version)).hexdigest()
+        self.set_header('Etag', self._etag)
+        return self._etag in self.request.headers.get('If-None-Match', '')
+
+    def finish_not_modified(self):
+        self.set_status(304)
+        self.finish()
+
+    def encode_success(self, **kwargs):
+        """ Encodes a successful response.
+
+        Meant to be called at the end of a `model.with_session`-method,
+        so the encoding happens in the worker thread and not on the
+        reactor, where a big response would hold up every other
+        request. Pass the result to `finish_with_encoded_json`.
+
+        Returns None if the client already has the response.
+        """
         kwargs.setdefault('ok', True)
-        self.write_json(kwargs)
+        encoded = encode_json(kwargs)
+
+        # Without a cheaper version, at least spare the client from downloading the same response again.
+        if self._etag is None and self.request.method in ('GET', 'HEAD') and self.check_etag(hashlib.sha1(encoded).hexdigest()):
+            return None
+
+        return self.choose_encoding(encoded, self.gzip(encoded) if self.accepts_gzip() else None)
+
+    def gzip(self, data):
+        """ Returns `data` gzipped at the application's `gzip_level`,
+        or None if it's shorter than `gzip_min_length`, or compression
+        is turned off with a level of 0.
+        """
+        level = self.settings.get('gzip_level', 6)
+        if not level or len(data) < self.settings.get('gzip_min_length', 1024):
+            return None
+        return gzip_encode(data, level)
+
+    def accepts_gzip(self):
+        return 'gzip' in self.request.headers.get('Accept-Encoding', '')
+
+    def choose_encoding(self, encoded, compressed):
+        """ Returns `compressed`, which is `encoded` gzipped, if the
+        client accepts it and it's not None. Otherwise `encoded`.
+        """
+        self.set_header('Vary', 'Accept-Encoding')
+        if compressed is None or not self.accepts_gzip():
+            return encoded
+
+        self.set_header('Content-Encoding', 'gzip')
+        if self._etag is not None:
+            # The bytes differ from the uncompressed response's.
+            self.set_header('Etag', 'W/' + self._etag)
+        return compressed
+
+    def finish_with_encoded_json(self, encoded):
+        """ Finishes with a response from `encode_success`, or with a
+        304 if there's nothing to send.
+        """
+        if encoded is None:
+            self.finish_not_modified()
+            return
+
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+        self.write(encoded)
         self.finish()
 
+    def succeed_with_json_and_finish(self, **kwargs):
+        self.finish_with_encoded_json(self.encode_success(**kwargs))
+
     def update_user_cookie(self):
         self.set_secure_cookie('u', encode_json(self.current_user))
 
@@ -0,0 +1,103 @@
+import logging
+import time
+
+from twisted.internet import defer, reactor
+
+from jr import cluster
+
+
+logger = logging.getLogger('jr')
+
+
+class BoardWatcher(object):
+    """ Keeps track of which version of the departure board is current.
+
+    Our own handlers call `changed` whenever they have committed
+    something that affects the board. Changes done directly in
+    JumpRun are detected by `update_fingerprint`, which is fed a cheap
+    summary of the manifest- and invoice-tables by the
+    `check-board-changes`-processor.
+
+    Clients waiting for a newer version than the one they have get
+    their deferreds fired as soon as the version changes.
+
+    In a cluster, the workers publish their changes, and the supervisor
+    decides which version they are all at, so they agree on the ETags.
+    """
+
+    def __init__(self):
+        # Versions start over when the process does, so they're only meaningful together with this.
+        self.epoch = cluster.epoch or int(time.time())
+        self.version = 1
+        self.fingerprint = None
+        self._waiting = []
+        # The timeouts of the deferreds in `_waiting` that have one.
+        self._timeout_calls = dict()
+
+    def changed(self):
+        self.version += 1
+        cluster.publish('board', version=self.version)
+        self._notify()
+
+    def catch_up(self, version):
+        """ Moves on to `version`, which the cluster has agreed on. """
+        if version > self.version:
+            self.version = version
+            self._notify()
+
+    def _notify(self):
+        logger.debug('Departure board is now at version %i' % self.version)
+
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(self.version)
+
+    def update_fingerprint(self, fingerprint):
+        if fingerprint == self.fingerprint:
+            return
+
+        is_first_fingerprint = self.fingerprint is None
+        self.fingerprint = fingerprint
+
+        # Nobody can have seen anything older than the first fingerprint.
+        if not is_first_fingerprint:
+            self.changed()
+
+    def wait_for_change(self, since, timeout=None):
+        """ Returns a deferred that fires with the current version as
+        soon as it differs from `since`, or when `timeout` seconds
+        have passed.
+        """
+        if since != self.version:
+            return defer.succeed(self.version)
+
+        d = defer.Deferred()
+        self._waiting.append(d)
+
+        if timeout:
+            self._timeout_calls[d] = reactor.callLater(timeout, self._stop_waiting, d)
+            d.addBoth(self._cancel_timeout, d)
+
+        return d
+
+    def stop_waiting(self, d):
+        """ Stop waiting on behalf of `d`, e.g. because the client went away. """
+        if d in self._waiting:
+            self._waiting.remove(d)
+        # `d` won't fire now, so neither will its callback cancelling the timeout.
+        self._cancel_timeout(None, d)
+
+    def _stop_waiting(self, d):
+        if d in self._waiting:
+            self._waiting.remove(d)
+            d.callback(self.version)
+
+    def _cancel_timeout(self, result, d):
+        timeout_call = self._timeout_calls.pop(d, None)
+        if timeout_call and timeout_call.active():
+            timeout_call.cancel()
+        return result
+
+
+watcher = BoardWatcher()
+cluster.subscribe('board', lambda message: watcher.catch_up(message['version']))
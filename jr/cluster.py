@@ -0,0 +1,101 @@
+""" The worker side of running the site in several processes.
+
+`jr-supervisor` (see `jr.supervisor`) starts a number of identical
+piped-processes sharing the listening sockets. Every process has its
+own caches --- the version of the departure board, `reference.data`,
+the suggest-index --- so the workers tell each other about changes
+through the supervisor, with datagrams on a Unix socket.
+
+Outside of a cluster, i.e. when started by piped directly, this is
+all a no-op: `index` is None and `publish` does nothing.
+"""
+import json
+import logging
+import os
+import socket
+
+from piped import resource
+from twisted.internet import protocol, reactor
+from zope import interface
+
+
+logger = logging.getLogger('jr')
+
+# Set by the supervisor for the processes it starts.
+directory = os.environ.get('JR_CLUSTER_DIRECTORY')
+index = int(os.environ['JR_WORKER_INDEX']) if 'JR_WORKER_INDEX' in os.environ else None
+size = int(os.environ.get('JR_WORKERS', 1))
+epoch = int(os.environ['JR_EPOCH']) if 'JR_EPOCH' in os.environ else None
+
+SUPERVISOR_SOCKET = 'supervisor.sock'
+
+_handlers = dict()
+channel = None
+
+
+def get_worker_socket(directory, index):
+    return os.path.join(directory, 'worker-%i.sock' % index)
+
+
+def is_primary():
+    """ Whether this process should do what only needs to be done
+    once for the whole cluster --- which it is unless it's one of the
+    other workers.
+    """
+    return not index
+
+
+def subscribe(type, handler):
+    """ Calls `handler` with every message of `type` published by the
+    other workers.
+    """
+    _handlers.setdefault(type, []).append(handler)
+
+
+def publish(type, **kwargs):
+    """ Tells the other workers about something. Thread safe. """
+    if channel is not None:
+        reactor.callFromThread(channel.send, dict(kwargs, type=type))
+
+
+class Channel(protocol.DatagramProtocol):
+
+    def __init__(self, supervisor_address):
+        self.supervisor_address = supervisor_address
+
+    def startProtocol(self):
+        # Lets the supervisor know we're (back) up, so it can tell us what we've missed.
+        self.send(dict(type='hello', index=index))
+
+    def send(self, message):
+        try:
+            self.transport.write(json.dumps(message), self.supervisor_address)
+        except socket.error as e:
+            logger.warn('Could not tell the supervisor about %s: %s' % (message['type'], e))
+
+    def datagramReceived(self, data, address):
+        message = json.loads(data)
+        for handler in _handlers.get(message['type'], []):
+            try:
+                handler(message)
+            except Exception:
+                logger.exception('Error handling %s-message from the cluster' % message['type'])
+
+
+class ClusterProvider(object):
+    """ Joins the cluster, if we're part of one. """
+    interface.classProvides(resource.IResourceProvider)
+
+    def configure(self, runtime_environment):
+        global channel
+        if directory is None or channel is not None:
+            return
+
+        address = get_worker_socket(directory, index)
+        if os.path.exists(address):
+            # Left behind by our predecessor.
+            os.unlink(address)
+
+        channel = Channel(os.path.join(directory, SUPERVISOR_SOCKET))
+        reactor.listenUNIXDatagram(address, channel)
+        logger.info('Joined the cluster in %s as worker %i of %i' % (directory, index, size))
@@ -6,69 +6,183 @@ import sqlalchemy as sa
 from sqlalchemy import orm
 from twisted.internet import defer, threads
 
-from jr import base, model, exceptions
+from jr import base, model, validation, exceptions
 
 
 class CustomerHandler(base.Handler):
+    read_database_dependency_spec = base.mirror_database_dependency_spec
+    # The balance is what's asked for, so don't let it lag much.
+    max_staleness = 10
 
     @defer.inlineCallbacks
     def get(self, customer_id):
-        customer = yield self._get_customer(customer_id)
+        self.finish_with_encoded_json((yield self._get_customer(customer_id)))
+
+    @model.with_read_only_session
+    def _get_customer(self, session, customer_id):
+        customer = session.query(model.Customer).options(*model.json_only(model.Customer)).get(customer_id)
         if not customer:
             raise exceptions.NoSuchResource('no customer with id %s' % customer_id)
 
-        self.succeed_with_json_and_finish(customer=customer)
+        return self.encode_success(customer=customer)
+
+
+class CustomerStatsHandler(base.Handler):
+    """ Jumps, revenue and payments per month and year for a customer,
+    from the statistics `jr.rollup` maintains in the mirror.
+    """
+    database_dependency_spec = base.mirror_database_dependency_spec
+
+    @defer.inlineCallbacks
+    def get(self, customer_id):
+        self.finish_with_encoded_json((yield self._get_stats(customer_id)))
 
     @model.with_session
-    def _get_customer(self, session, customer_id):
-        return session.query(model.Customer).get(customer_id)
+    def _get_stats(self, session, customer_id):
+        if not session.query(model.Customer).get(customer_id):
+            raise exceptions.NoSuchResource('no customer with id %s' % customer_id)
+
+        months = (
+            session.query(model.CustomerMonthlyStats).
+            filter(model.CustomerMonthlyStats.customer_id == customer_id).
+            order_by(sa.desc(model.CustomerMonthlyStats.month))
+        ).all()
+
+        years = dict()
+        total = dict(jumps=0, revenue=0, payments=0)
+        for month in months:
+            year = years.setdefault(month.month.year, dict(year=month.month.year, jumps=0, revenue=0, payments=0))
+            for key in ('jumps', 'revenue', 'payments'):
+                year[key] += getattr(month, key)
+                total[key] += getattr(month, key)
+
+        return self.encode_success(
+            months=months,
+            years=sorted(years.values(), key=lambda year: year['year'], reverse=True),
+            total=total
+        )
+
+
+class _ArchivePageHandler(base.Handler):
+    """ Base for handlers listing today's rows for a customer along
+    with a page of the archived ones.
+
+    The archived rows are paginated by (business date, id), newest
+    first, so fetching a page costs the same no matter how long the
+    customer's history is. Pass `limit` and, for the following pages,
+    the `next_page` cursor of the previous response as `before`. The
+    total number of archived rows is returned in `X-Total-Count`.
+    """
+    page_size = 50
+    max_page_size = 500
+
+    validators = dict(
+        page=validation.Page
+    )
+
+    def get_page_spec(self):
+        spec = self.get_validated_data('page', before=self.get_argument('before', None), limit=self.get_argument('limit', None))
+        spec['limit'] = min(spec['limit'] or self.page_size, self.max_page_size)
+        return spec
+
+    def get_page(self, query, Relation, id_column, spec):
+        if spec['before']:
+            business_date, id = spec['before']
+            query = query.filter(sa.or_(
+                Relation.business_date < business_date,
+                sa.and_(Relation.business_date == business_date, id_column < id)
+            ))
 
+        # Get one extra to know whether there are more.
+        rows = query.order_by(sa.desc(Relation.business_date), sa.desc(id_column)).limit(spec['limit'] + 1).all()
+        rows, more = rows[:spec['limit']], rows[spec['limit']:]
 
-class PaymentHandler(base.Handler):
+        next_page = None
+        if more:
+            next_page = validation.format_cursor(rows[-1].business_date, getattr(rows[-1], id_column.key))
+
+        return rows, next_page
+
+
+class PaymentHandler(_ArchivePageHandler):
 
     @defer.inlineCallbacks
     def get(self, customer_id):
-        customer = yield self._get_customer(customer_id)
-        self.succeed_with_json_and_finish(
-            todays_payments=customer.payments,
-            earlier_payments=customer.archived_payments
-        )
+        spec = self.get_page_spec()
+        self.finish_with_encoded_json((yield self._get_payments(customer_id, spec)))
 
     @model.with_session
-    def _get_customer(self, session, customer_id):
-        customer = (
-            session.query(model.Customer).
-            options(
-                orm.eagerload_all('payments'),
-                orm.eagerload_all('archived_payments')
-            ).
-            get(customer_id)
-        )
-        if not customer:
+    def _get_payments(self, session, customer_id, spec):
+        if not session.query(model.Customer).get(customer_id):
             raise exceptions.NoSuchResource('no customer with id %s' % customer_id)
 
-        return customer
+        version = (
+            model.get_change_summary(session, model.Payment.__table__, model.Payment.customer_id == customer_id) +
+            model.get_change_summary(session, model.ArchivedPayment.__table__, model.ArchivedPayment.customer_id == customer_id)
+        )
+        self.set_header('X-Total-Count', version[4])
+        if self.check_etag(*version):
+            return None
+
+        todays_payments = (
+            session.query(model.Payment).options(*model.json_only(model.Payment)).
+            filter(model.Payment.customer_id == customer_id)
+        ).all()
+        earlier_payments, next_page = self.get_page(
+            session.query(model.ArchivedPayment).options(*model.json_only(model.ArchivedPayment)).
+            filter(model.ArchivedPayment.customer_id == customer_id),
+            model.ArchivedPayment, model.ArchivedPayment.payment_id, spec
+        )
+
+        return self.encode_success(
+            todays_payments=todays_payments,
+            earlier_payments=earlier_payments,
+            next_page=next_page
+        )
 
 
-class InvoiceHandler(base.Handler):
+class InvoiceHandler(_ArchivePageHandler):
 
     @defer.inlineCallbacks
     def get(self, customer_id):
-        self.succeed_with_json_and_finish(**(yield self._get_invoices(customer_id)))
+        spec = self.get_page_spec()
+        self.finish_with_encoded_json((yield self._get_invoices(customer_id, spec)))
 
     @model.with_session
-    def _get_invoices(self, session, customer_id):
+    def _get_invoices(self, session, customer_id, spec):
+        if not session.query(model.Customer).get(customer_id):
+            raise exceptions.NoSuchResource('no customer with id %s' % customer_id)
+
         def make_query(Relation):
             query = (
                 session.query(Relation).join(model.Item).
-                options(orm.contains_eager('item')).
+                options(orm.contains_eager('item'), *(model.json_only(Relation) + model.json_only(model.Item, 'item'))).
                 filter(Relation.customer_id == customer_id)
             )
             if self.get_argument('item_type', None):
-                query = query.filter(model.Item.item_type.in_(self.get_argument('item_type').split(';')))
+                # The names of `model.item_types`, which aren't a column.
+                item_types = self.get_argument('item_type').split(';')
+                query = query.filter(model.Item._item_type.in_([code for code, name in model.item_types.items() if name in item_types]))
             return query
 
-        return dict(
+        version = (
+            model.get_change_summary(session, model.Invoice.__table__, model.Invoice.customer_id == customer_id) +
+            model.get_change_summary(session, model.ArchivedInvoice.__table__, model.ArchivedInvoice.customer_id == customer_id) +
+            # The item of every invoice is part of the response.
+            model.get_change_summary(session, model.Item.__table__)
+        )
+        if not self.get_argument('item_type', None):
+            self.set_header('X-Total-Count', version[4])
+        if self.check_etag(*version):
+            return None
+        if self.get_argument('item_type', None):
+            # The summary counts every archived invoice of the customer, regardless of their items.
+            self.set_header('X-Total-Count', make_query(model.ArchivedInvoice).count())
+
+        earlier_jumps, next_page = self.get_page(make_query(model.ArchivedInvoice), model.ArchivedInvoice, model.ArchivedInvoice.invoice_id, spec)
+
+        return self.encode_success(
             todays_jumps=make_query(model.Invoice).all(),
-            earlier_jumps=make_query(model.ArchivedInvoice).order_by(sa.desc(model.ArchivedInvoice.business_date)).all()
+            earlier_jumps=earlier_jumps,
+            next_page=next_page
         )
@@ -0,0 +1,140 @@
+""" Allocation of the ids JumpRun expects us to come up with ourselves.
+
+JumpRun has no sequences: it does a MAX(id) + 1 on every insert, and
+so did we. Instead, an `IdAllocator` per engine and column does the
+MAX() once and hands out the following ids from memory.
+
+JumpRun itself keeps inserting rows, and may take an id we were about
+to hand out. The flush then fails with a duplicate key, and
+`retrying_on_collision` resynchronizes the allocators of that table
+and retries. Other integrity errors are the request's fault, and
+aren't retried.
+The allocators also resynchronize every `max_age` seconds, so the ids
+start over after the nightly day change, like JumpRun's do.
+
+The workers of a cluster would all do the same MAX() and hand out the
+same ids, so each of them takes every `cluster.size`th id instead.
+"""
+import functools
+import logging
+import re
+import threading
+import time
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+from twisted.python import reflect
+
+from jr import cluster, exceptions
+
+
+logger = logging.getLogger('jr')
+
+
+class IdAllocator(object):
+    max_age = 600
+
+    def __init__(self, column, offset=0, stride=1):
+        self.column = column
+        self.offset = offset
+        self.stride = stride
+        self.allocated = 0
+        self.syncs = 0
+        self.collisions = 0
+        self._next_id = None
+        self._synced_at = 0
+        self._lock = threading.Lock()
+
+    def allocate(self, session):
+        with self._lock:
+            if self._next_id is None or time.time() - self._synced_at > self.max_age:
+                self._sync(session)
+
+            id = self._next_id
+            self._next_id += self.stride
+            self.allocated += 1
+            return id
+
+    def _sync(self, session):
+        next_id = (session.execute(sa.select([sa.func.max(self.column)])).scalar() or 0) + 1
+        self._next_id = next_id + (self.offset - next_id) % self.stride
+        self._synced_at = time.time()
+        self.syncs += 1
+
+    def collided(self):
+        with self._lock:
+            self._next_id = None
+            self.collisions += 1
+
+    def get_stats(self):
+        return dict(allocated=self.allocated, syncs=self.syncs, collisions=self.collisions, next_id=self._next_id)
+
+
+allocators = dict()
+_allocators_lock = threading.Lock()
+
+
+def allocate(session, column):
+    """ Returns the next free id of the `column` of a table. """
+    key = session.get_bind(), column.table.name, column.name
+    if key not in allocators:
+        with _allocators_lock:
+            allocators.setdefault(key, IdAllocator(column, cluster.index or 0, cluster.size))
+    return allocators[key].allocate(session)
+
+
+# How the databases say a key is taken: Postgres' unique_violation, and the messages of the rest.
+DUPLICATE_KEY_CODE = '23505'
+DUPLICATE_KEY_MESSAGES = ('duplicate key', 'unique constraint', 'is not unique', 'must be unique', 'violation of primary key')
+
+
+def is_collision(error, table_name, column_name):
+    """ Whether `error` says a key was taken in `column_name` of
+    `table_name`, rather than something else being wrong.
+    """
+    if isinstance(error, orm.exc.FlushError):
+        # The session notices itself if the row was already loaded, and says so with its identity key.
+        match = re.search(r"identity key \(<class '([\w.]+)'>", str(error))
+        return bool(match) and orm.class_mapper(reflect.namedAny(match.group(1))).local_table.name == table_name
+
+    message = str(error.orig)
+    if getattr(error.orig, 'pgcode', None) != DUPLICATE_KEY_CODE and not any(part in message.lower() for part in DUPLICATE_KEY_MESSAGES):
+        return False
+    match = re.match(r'\s*INSERT INTO [\["]?(\w+)', error.statement or '', re.IGNORECASE)
+    return bool(match) and match.group(1) == table_name and column_name in message
+
+
+def retrying_on_collision(method, attempts=3):
+    """ Retries the wrapped `with_session`-method, after rolling back
+    and resynchronizing the allocators of the table, if it fails
+    because an id we allocated was taken in the meantime.
+
+    Other integrity errors, such as a missing foreign key, are raised
+    as `exceptions.Conflict` right away.
+    """
+    @functools.wraps(method)
+    def wrapper(self, session, *args, **kwargs):
+        for attempt in range(attempts):
+            try:
+                return method(self, session, *args, **kwargs)
+            except (sa.exc.IntegrityError, orm.exc.FlushError) as e:
+                session.rollback()
+                bind = session.get_bind()
+                collided = [allocator for (engine, table_name, column_name), allocator in allocators.items()
+                            if engine is bind and is_collision(e, table_name, column_name)]
+                if not collided:
+                    if isinstance(e, sa.exc.IntegrityError):
+                        logger.info('%s violated a constraint: %s' % (method.__name__, e))
+                        raise exceptions.Conflict('the change violates a constraint of the database')
+                    raise
+                if attempt == attempts - 1:
+                    raise
+
+                logger.warn('Retrying %s, as an allocated id was taken: %s' % (method.__name__, e))
+                for allocator in collided:
+                    allocator.collided()
+    return wrapper
+
+
+def get_stats():
+    return dict(('%s.%s' % (table_name, column_name), allocator.get_stats()) for (engine, table_name, column_name), allocator in allocators.items())
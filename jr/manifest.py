@@ -1,8 +1,100 @@
+import collections
+import datetime
+
 import sqlalchemy as sa
 from sqlalchemy import orm
 from twisted.internet import defer
+from twisted.python import failure
+
+from jr import base, board, ids, model, reference, validation, exceptions
+
+
+@model.cached_query
+def _get_board_query(by_plane, by_manifest):
+    query = (
+        model.Query(model.Plane).outerjoin(model.Manifest).
+        filter(model.Plane.plane_id > 0). # There's a "non-manifest" manifest for counter sales, etc.
+        filter(model.Plane.is_active == True).
+        options(
+            orm.eagerload_all('manifests.invoices.customer'),
+            # Only what ends up in the JSON.
+            *(
+                model.json_only(model.Plane) +
+                model.json_only(model.Manifest, 'manifests') +
+                model.json_only(model.Invoice, 'manifests.invoices') +
+                model.json_only(model.Customer, 'manifests.invoices.customer')
+            )
+        )
+    )
+    if by_plane:
+        query = query.filter(model.Plane.plane_id == sa.bindparam('plane_id'))
+
+    # Not really needed?
+    if by_manifest:
+        query = query.filter(model.Manifest.manifest_id == sa.bindparam('manifest_id'))
+
+    return query
+
+
+@model.cached_query
+def _get_manifest_query():
+    # Without the invoices: whether there's room for another is up to _reserve_seat.
+    return (
+        model.Query(model.Manifest).
+        join(model.Plane).
+        options(orm.contains_eager('plane')).
+        filter(model.Manifest.manifest_id == sa.bindparam('manifest_id')).
+        filter(model.Plane.plane_id == sa.bindparam('plane_id'))
+    )
+
 
-from jr import base, model, validation, exceptions
+def _reserve_seat(session, plane_id, manifest_id, customer_id):
+    """ Takes a seat on the load for the customer, unless it's at the
+    capacity of the plane or the customer is already on it. Returns
+    whether it did.
+
+    Check and increment is one conditional UPDATE, which locks the row
+    of the load, so two desks can't both take its last seat.
+    """
+    manifests, invoices, planes = model.Manifest.__table__, model.Invoice.__table__, model.Plane.__table__
+    capacity = sa.select([planes.c.nCapacity]).where(planes.c.nId == manifests.c.nPlaneId).as_scalar()
+    is_on_load = sa.exists().where(invoices.c.nMani == manifests.c.nMani).where(invoices.c.wCustId == customer_id)
+
+    # Jumpers added earlier in the same transaction must count too.
+    session.flush()
+    return session.execute(
+        manifests.update().
+        where(manifests.c.nMani == manifest_id).
+        where(manifests.c.nPlaneId == plane_id).
+        where(manifests.c.nRiders < capacity).
+        where(~is_on_load).
+        # What maintain_balances does for the loads it sees change.
+        values(nRiders=manifests.c.nRiders + 1, dtUpdate=datetime.datetime.now())
+    ).rowcount == 1
+
+
+@model.cached_query
+def _get_customer_item_query():
+    return (model.Query(model.Invoice).join(model.Manifest).
+        filter(model.Invoice.item_id == sa.bindparam('existing_item_id')).
+        filter(model.Invoice.customer_id == sa.bindparam('customer_id')).
+        filter(model.Manifest.manifest_id == sa.bindparam('manifest_id')).
+        filter(model.Manifest.plane_id == sa.bindparam('plane_id'))
+    )
+
+
+def get_planes(session, plane_id=None, manifest_id=None):
+    """ Returns the active planes with their manifests, for the departure board. """
+    query = (
+        _get_board_query(bool(plane_id), bool(manifest_id)).
+        with_session(session).
+        params(plane_id=plane_id, manifest_id=manifest_id)
+    )
+
+    planes = query.all()
+    # The items come from the cache, and are already serialized.
+    reference.data.set_items(session, [invoice for plane in planes for manifest in plane.manifests for invoice in manifest.invoices])
+    return planes
 
 
 class ManifestHandler(base.Handler):
@@ -17,42 +109,39 @@ class ManifestHandler(base.Handler):
 
     @defer.inlineCallbacks
     def get(self, plane_id=None, manifest_id=None, customer_id=None, item_id=None):
-        self.succeed_with_json_and_finish(planes=(yield self._get_planes_and_manifests(plane_id, manifest_id)))
+        # Get the version before querying, so a change while we query results in a re-fetch.
+        version = board.watcher.version
+        if self.check_etag(board.watcher.epoch, version):
+            self.finish_not_modified()
+            return
 
-    def _get_matching_planes_and_manifests(self, session, plane_id, manifest_id=None):
-        query = (
-            session.query(model.Plane).outerjoin(model.Manifest).
-            filter(model.Plane.plane_id > 0). # There's a "non-manifest" manifest for counter sales, etc.
-            filter(model.Plane.is_active == True).
-            options(
-                orm.eagerload_all('manifests.invoices.item'),
-                orm.eagerload_all('manifests.invoices.customer')
-            )
-        )
-        if plane_id:
-            query = query.filter(model.Plane.plane_id==plane_id)
-
-        # Not really needed?
-        if manifest_id:
-            query = query.filter(model.Manifest.manifest_id==manifest_id)
+        self.finish_with_encoded_json((yield self._get_planes_and_manifests(version, plane_id, manifest_id)))
 
-        return query.all()
+    def _get_matching_planes_and_manifests(self, session, plane_id, manifest_id=None):
+        return get_planes(session, plane_id, manifest_id)
 
-    _get_planes_and_manifests = model.with_session(_get_matching_planes_and_manifests)
+    @model.with_session
+    def _get_planes_and_manifests(self, session, version, plane_id, manifest_id=None):
+        planes = self._get_matching_planes_and_manifests(session, plane_id, manifest_id)
+        return self.encode_success(version=version, planes=planes)
 
     @defer.inlineCallbacks
     def post(self, plane_id, manifest_id=None, customer_id=None, item_id=None):
         if manifest_id:
             spec = self.get_validated_post_data('add_jumper', dict(plane_id=plane_id, manifest_id=manifest_id))
-            self.succeed_with_json_and_finish(result=(yield self._add_jumper(spec)))
+            result = yield self._add_jumper(spec)
+            board.watcher.changed()
+            self.succeed_with_json_and_finish(result=result)
         else:
             spec = self.get_validated_post_data('add_manifest', dict(plane_id=plane_id))
             manifest = yield self._add_manifest(spec)
+            board.watcher.changed()
             self.succeed_with_json_and_finish(manifest=manifest)
 
     @model.with_session
+    @ids.retrying_on_collision
     def _add_manifest(self, session, spec):
-        plane = session.query(model.Plane).get(spec['plane_id'])
+        plane = reference.data.get_plane(session, spec['plane_id'])
         if not plane:
             raise exceptions.NoSuchResource('no such plane')
 
@@ -66,21 +155,18 @@ class ManifestHandler(base.Handler):
         return manifest
 
     @model.with_session
+    @ids.retrying_on_collision
     def _add_jumper(self, session, spec):
+        result = self._apply_add_jumper(session, spec)
+        session.commit()
+        return result
+
+    def _apply_add_jumper(self, session, spec):
+        """ Adds the jumper described by `spec`, without committing. """
         plane_id = spec['plane_id']
         manifest_id = spec['manifest_id']
 
-        manifest = (
-            session.query(model.Manifest).
-            join(model.Plane).
-            options(
-                orm.eagerload_all('invoices'),
-                orm.contains_eager('plane')
-                ).
-            filter(model.Manifest.manifest_id == manifest_id).
-            filter(model.Plane.plane_id == plane_id).
-            first()
-        )
+        manifest = _get_manifest_query().with_session(session).params(manifest_id=manifest_id, plane_id=plane_id).first()
 
         if not manifest:
             raise exceptions.NoSuchResource('no such plane/manifest: %s/%s' % (plane_id, manifest_id))
@@ -91,7 +177,7 @@ class ManifestHandler(base.Handler):
             raise exceptions.BadRequest('no customer with id "%s"' % customer_id)
 
         item_id = spec['item_id']
-        item = session.query(model.Item).get(item_id)
+        item = reference.data.get_item(session, item_id)
         if not item:
             raise exceptions.BadRequest('no item with id "%s"' % item_id)
 
@@ -99,18 +185,10 @@ class ManifestHandler(base.Handler):
             raise exceptions.BadRequest('item is not a jump or a jump-modifier')
 
         if item.item_type == 'jump':
-            if manifest.number_of_jumpers == manifest.plane.capacity:
-                raise exceptions.LoadIsFull('at capacity')
-
-            for invoice in manifest.invoices:
-                if invoice.customer_id == customer_id:
-                    raise exceptions.AlreadyOnLoad('user already occupies a slot')
-
-            manifest.number_of_jumpers += 1
+            self._take_seat(session, manifest, customer_id)
 
-        invoice_id = (session.execute(sa.select([sa.func.max(model.Invoice.invoice_id)])).scalar() or 0) + 1
         invoice = model.Invoice()
-        invoice.invoice_id = invoice_id
+        invoice.invoice_id = ids.allocate(session, model.Invoice.__table__.c.wId)
         invoice.customer = customer
         invoice.bill_to_id = customer_id
         invoice.item = item
@@ -123,18 +201,44 @@ class ManifestHandler(base.Handler):
         invoice.price = price
         invoice.manual_price = spec.get('price') is not None
 
-        manifest.invoices.append(invoice)
+        # Not through manifest.invoices, which would load every invoice of the load.
+        invoice.manifest_id = manifest_id
+        session.add(invoice)
 
         # Note. Setting the customer's "last_jump" is done by the
         # day-change stored procedure. (Also, what would happen if we
         # were to set it here, and then delete the jump? Anyway, the
         # sensible way to get last_jump is to actually query for it.
 
-        session.commit()
-
         # Return customer and manifest, as those are changed as a result of adding the jumper.
         return dict(customer=customer, manifest=manifest)
 
+    def _take_seat(self, session, manifest, customer_id, attempts=3):
+        """ Reserves a seat on `manifest`, or raises why it couldn't. """
+        for attempt in range(attempts):
+            if _reserve_seat(session, manifest.plane_id, manifest.manifest_id, customer_id):
+                # Reloaded now, as the serializer doesn't load what's expired.
+                session.refresh(manifest, ['number_of_jumpers', 'last_modified'])
+                return
+
+            # Only when there's no seat to be had do we look at why.
+            is_on_load = session.query(
+                session.query(model.Invoice).
+                filter(model.Invoice.manifest_id == manifest.manifest_id).
+                filter(model.Invoice.customer_id == customer_id).
+                exists()
+            ).scalar()
+            if is_on_load:
+                raise exceptions.AlreadyOnLoad('user already occupies a slot')
+
+            session.expire(manifest, ['number_of_jumpers'])
+            if manifest.number_of_jumpers >= manifest.plane.capacity:
+                raise exceptions.LoadIsFull('at capacity')
+
+            # Someone freed a seat since we tried. Try again.
+
+        raise exceptions.Conflict('the load is changing too fast, please try again')
+
     @defer.inlineCallbacks
     def patch(self, plane_id, manifest_id=None, customer_id=None, item_id=None):
         if customer_id:
@@ -144,15 +248,20 @@ class ManifestHandler(base.Handler):
             spec = self.get_validated_post_data('update_manifest', dict(plane_id=plane_id, manifest_id=manifest_id))
             result = yield self._update_manifest(plane_id, manifest_id)
 
+        board.watcher.changed()
         self.succeed_with_json_and_finish(result=result)
 
     @model.with_session
     def _update_customer_item(self, session, spec):
-        invoice = (session.query(model.Invoice).join(model.Manifest).
-            filter(model.Invoice.item_id == spec['existing_item_id']).
-            filter(model.Invoice.customer_id == spec['customer_id']).
-            filter(model.Manifest.manifest_id == spec['manifest_id']).
-            filter(model.Manifest.plane_id == spec['plane_id'])
+        invoice = self._apply_update_customer_item(session, spec)
+        session.commit()
+        return invoice
+
+    def _apply_update_customer_item(self, session, spec):
+        invoice = (
+            _get_customer_item_query().with_session(session).
+            params(existing_item_id=spec['existing_item_id'], customer_id=spec['customer_id'],
+                   manifest_id=spec['manifest_id'], plane_id=spec['plane_id'])
         ).first()
 
         if not invoice:
@@ -162,7 +271,6 @@ class ManifestHandler(base.Handler):
             if value is not Ellipsis and hasattr(invoice, key):
                 setattr(invoice, key, value)
 
-        session.commit()
         return invoice
 
     @defer.inlineCallbacks
@@ -171,6 +279,7 @@ class ManifestHandler(base.Handler):
             raise exceptions.BadRequest('please specify a manifest to delete')
 
         result = yield self._process_delete(dict(plane_id=plane_id, manifest_id=manifest_id, customer_id=customer_id, item_id=item_id))
+        board.watcher.changed()
 
         if customer_id:
             self.succeed_with_json_and_finish(invoices=result)
@@ -179,31 +288,7 @@ class ManifestHandler(base.Handler):
 
     @model.with_session
     def _process_delete(self, session, spec):
-        query = (
-            session.query(model.Invoice).join('manifest', 'plane').join('customer').join('item').
-            filter(model.Manifest.manifest_id == spec['manifest_id']).
-            filter(model.Plane.plane_id == spec['plane_id'])
-        )
-
-        if spec.get('customer_id'):
-            query = query.filter(model.Customer.customer_id == spec['customer_id'])
-
-        if spec.get('item_id'):
-            query = query.filter(model.Item.item_id == spec['item_id'])
-
-        # Note that model.maintain_balances is invoked as a
-        # side-effect, which is why it's not just a delete-call here.
-        invoices = query.all()
-        for invoice in invoices:
-            session.delete(invoice)
-
-
-        # Delete the entire manifest if no customer was specified.
-        if not (spec.get('customer_id') or spec.get('item_id')):
-            session.execute(model.Manifest.__table__.delete().
-                            where(model.Manifest.manifest_id == spec['manifest_id']).
-                            where(model.Manifest.plane_id == spec['plane_id']))
-
+        self._apply_delete(session, spec)
         session.commit()
 
         if spec.get('customer_id'):
@@ -226,3 +311,184 @@ class ManifestHandler(base.Handler):
                 ).
                 filter(model.Manifest.plane_id == spec['plane_id'])
             ).all()
+
+    def _apply_delete(self, session, spec):
+        """ Deletes the matching invoices (or the entire manifest, if no
+        customer or item is given) and adjusts the balances, with a
+        handful of statements no matter how many jumpers there are.
+        """
+        invoices = model.Invoice.__table__
+        manifests = model.Manifest.__table__
+
+        criteria = [
+            invoices.c.nMani == spec['manifest_id'],
+            sa.exists().where(manifests.c.nMani == invoices.c.nMani).where(manifests.c.nPlaneId == spec['plane_id'])
+        ]
+        if spec.get('customer_id'):
+            criteria.append(invoices.c.wCustId == spec['customer_id'])
+        if spec.get('item_id'):
+            criteria.append(invoices.c.wItemId == spec['item_id'])
+        criteria = sa.and_(*criteria)
+
+        # The statements below bypass the session, so get what's pending into the database first.
+        session.flush()
+
+        # What model.maintain_balances would have done for each invoice, had we deleted them one by one.
+        reference.data.refresh(session)
+        deltas = collections.defaultdict(int)
+        jumps = 0
+        for customer_id, item_id, price, count in session.execute(
+                sa.select([invoices.c.wCustId, invoices.c.wItemId, sa.func.sum(invoices.c.cPrice), sa.func.count()]).
+                where(criteria).
+                group_by(invoices.c.wCustId, invoices.c.wItemId)):
+            deltas[customer_id] -= price or 0
+            item = reference.data.items.get(item_id)
+            if item is not None and item.item_type == 'jump':
+                jumps += count
+
+        model.adjust_balances(session, deltas)
+        session.execute(invoices.delete().where(criteria))
+
+        where_manifest = sa.and_(manifests.c.nMani == spec['manifest_id'], manifests.c.nPlaneId == spec['plane_id'])
+        if not (spec.get('customer_id') or spec.get('item_id')):
+            # Delete the entire manifest if no customer was specified.
+            session.execute(manifests.delete().where(where_manifest))
+        elif jumps:
+            # Free the slots, as _apply_add_jumper takes one per jump.
+            session.execute(manifests.update().where(where_manifest).values(nRiders=manifests.c.nRiders - jumps))
+
+        # Forget what we had loaded, as some of it is now gone.
+        session.flush()
+        session.expire_all()
+
+
+class BatchHandler(ManifestHandler):
+    """ Applies a list of operations on jumpers in one transaction, e.g.
+    to manifest a whole group at once. Either all of them succeed, or
+    none of them do.
+
+    Expects {"operations": [...]}, where every operation is an object
+    with an "op" and the same fields as the corresponding single
+    request:
+
+    - "add": plane_id, manifest_id, customer_id, item_id and optionally
+      comment and price.
+    - "update": plane_id, manifest_id, customer_id, existing_item_id
+      and comment and/or price.
+    - "delete": plane_id, manifest_id, customer_id and optionally
+      item_id.
+
+    Moving a jumper is a delete and an add. Returns the manifests that
+    were touched.
+    """
+    SUPPORTED_METHODS = {"POST"}
+    max_operations = 100
+
+    validators = dict(
+        batch=validation.Batch
+    )
+
+    @defer.inlineCallbacks
+    def post(self):
+        operations = self.get_validated_post_data('batch')['operations']
+        if len(operations) > self.max_operations:
+            raise exceptions.BadRequest('at most %i operations at a time' % self.max_operations)
+
+        manifests = yield self._apply_operations(operations)
+        board.watcher.changed()
+        self.succeed_with_json_and_finish(manifests=manifests)
+
+    @model.with_session
+    @ids.retrying_on_collision
+    def _apply_operations(self, session, operations):
+        apply = dict(
+            add=self._apply_add_jumper,
+            update=self._apply_update_customer_item,
+            delete=self._apply_delete,
+        )
+
+        manifest_ids = set()
+        for op, spec in operations:
+            apply[op](session, spec)
+            manifest_ids.add(spec['manifest_id'])
+
+        session.commit()
+
+        manifests = (
+            session.query(model.Manifest).
+            options(orm.eagerload_all('invoices.customer')).
+            filter(model.Manifest.manifest_id.in_(manifest_ids))
+        ).all()
+        reference.data.set_items(session, [invoice for manifest in manifests for invoice in manifest.invoices])
+        return manifests
+
+
+class BoardChangesHandler(ManifestHandler):
+    """ Long-polling version of the planes-listing.
+
+    The client passes the `version` it got with its last board, and
+    the request is held until the board has changed, or until
+    `long_poll_timeout` seconds have passed. The board is queried and
+    encoded once per version, no matter how many clients are waiting.
+    """
+    SUPPORTED_METHODS = {"GET", "HEAD"}
+    long_poll_timeout = 25
+
+    _snapshot_version = None
+    _snapshot = None
+
+    @defer.inlineCallbacks
+    def get(self):
+        since = self.get_argument('since', None)
+        since = int(since) if since and since.isdigit() else None
+
+        d = board.watcher.wait_for_change(since, self.long_poll_timeout)
+        self.notifyFinish().addBoth(lambda _: board.watcher.stop_waiting(d))
+        version = yield d
+
+        if version == since:
+            # Nothing happened. Tell the client to just ask again.
+            self.succeed_with_json_and_finish(version=version)
+            return
+
+        encoded_board, compressed_board = yield self._get_snapshot(version)
+        if self._finished:
+            return
+
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+        self.finish(self.choose_encoding(encoded_board, compressed_board))
+
+    def _get_snapshot(self, version):
+        cls = type(self)
+        if cls._snapshot_version != version:
+            cls._snapshot_version = version
+            cls._snapshot = self._get_encoded_snapshot(version)
+            cls._snapshot.addErrback(self._forget_snapshot, version, cls._snapshot)
+
+        # Everyone waiting for the same version shares the result.
+        d = defer.Deferred()
+        cls._snapshot.addBoth(self._pass_on, d)
+        return d
+
+    @model.with_session
+    def _get_encoded_snapshot(self, session, version):
+        # Not encode_success, as this is shared with other clients --- whether they accept gzip or not.
+        planes = self._get_matching_planes_and_manifests(session, None)
+        encoded = base.encode_json(dict(ok=True, version=version, planes=planes))
+        return encoded, self.gzip(encoded)
+
+    @classmethod
+    def _forget_snapshot(cls, reason, version, snapshot):
+        if cls._snapshot_version == version:
+            cls._snapshot_version = cls._snapshot = None
+        # Nobody gets to wait for `snapshot` any more, so once everyone already waiting has had the failure
+        # passed on, it's been handled.
+        snapshot.addErrback(lambda reason: None)
+        return reason
+
+    def _pass_on(self, result, d):
+        if isinstance(result, failure.Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+        return result
@@ -0,0 +1,231 @@
+""" The indexes and partitions of the Postgres-mirror.
+
+The mirror starts out with just the tables `jr.model` implies. What
+it's read for, though, is the history of a customer --- their archived
+invoices and payments, newest first --- and the archived loads of a
+range of days, for the reports. And the archive grows every season.
+So,
+
+    jr-mirror-schema -c sync-server.yaml
+
+creates the indexes of `INDEXES`, and turns the archive-tables into
+tables range-partitioned by `dtProcess`, with one partition per season
+and a default partition for whatever has no season of its own. It's
+safe to run again; it only does what isn't done yet.
+
+The partitions of new seasons are made as they're needed: the
+`apply-jr-changes`-processor makes the partition of a season when it
+first gets rows of it, and the `truncate-and-restore-jr-tables`-
+processor moves the restored rows out of the default partitions.
+
+The partitioned tables don't get the foreign keys of the tables they
+replace. The mirror gets what JumpRun has already checked, and the
+changes arrive in no particular order. Needs Postgres 11 or newer.
+"""
+import argparse
+import datetime
+import logging
+import time
+
+import sqlalchemy as sa
+from piped import conf
+
+from jr import model
+
+
+logger = logging.getLogger('jr.mirror')
+
+MINIMUM_SERVER_VERSION = (11, )
+
+# Range-partitioned by the season of `dtProcess`, in the order they're partitioned.
+PARTITIONED_TABLES = ('tManiAll', 'tInvAll', 'tPmtAll')
+PARTITION_KEY = 'dtProcess'
+DEFAULT_PARTITION = '%s_default'
+SEASON_PARTITION = '%s_%i'
+
+# Partitions are made for this many seasons ahead of the current.
+SEASONS_AHEAD = 1
+
+# (name, table, what's indexed)
+INDEXES = (
+    # A customer's history, paginated by (business date, id), newest first: `jr.customer`.
+    ('ix_tInvAll_customer', 'tInvAll', '"wCustId", "dtProcess" DESC, "wId" DESC'),
+    ('ix_tPmtAll_customer', 'tPmtAll', '"wCustId", "dtProcess" DESC, "wId" DESC'),
+    # The loads of a range of days, and their invoices: `jr.report`.
+    ('ix_tManiAll_date', 'tManiAll', '"dtProcess", "nMani", "nPlaneId"'),
+    ('ix_tInvAll_manifest', 'tInvAll', '"dtProcess", "nMani"'),
+)
+
+
+def get_season(business_date):
+    """ The season of `business_date`. We don't jump in the winter, so
+    the seasons are the calendar years.
+    """
+    return business_date.year
+
+
+def get_season_range(season):
+    """ [start, end) of the dates of `season`. """
+    return datetime.datetime(season, 1, 1), datetime.datetime(season + 1, 1, 1)
+
+
+def is_postgres(connection):
+    return connection.dialect.name == 'postgresql'
+
+
+def is_partitioned(connection, table_name):
+    return bool(connection.execute(sa.text('''
+        SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid
+        WHERE c.relname = :table_name AND pg_table_is_visible(c.oid)
+    '''), table_name=table_name).scalar())
+
+
+def get_partitions(connection, table_name):
+    """ The names of the partitions of `table_name`. """
+    return set(name for name, in connection.execute(sa.text('''
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = :table_name AND pg_table_is_visible(p.oid)
+    '''), table_name=table_name))
+
+
+def get_seasons(connection, table_name):
+    """ The seasons `table_name` has rows of. """
+    return set(int(season) for season, in connection.execute(
+        'SELECT DISTINCT extract(year FROM "%s") FROM "%s"' % (PARTITION_KEY, table_name)
+    ) if season is not None)
+
+
+def ensure_indexes(connection):
+    for name, table_name, expressions in INDEXES:
+        logger.info('Ensuring index "%s" on "%s"' % (name, table_name))
+        connection.execute('CREATE INDEX IF NOT EXISTS "%s" ON "%s" (%s)' % (name, table_name, expressions))
+
+
+def partition_table(connection, table_name, seasons):
+    """ Replaces the unpartitioned `table_name` by one partitioned by
+    season, with partitions for `seasons` and those it has rows of.
+    """
+    table = model.Base.metadata.tables[table_name]
+    new_table_name = table_name + '_partitioned'
+    seasons = set(seasons) | get_seasons(connection, table_name)
+
+    logger.info('Partitioning "%s" into the seasons %s' % (table_name, ', '.join(str(season) for season in sorted(seasons))))
+    connection.execute('CREATE TABLE "%s" (LIKE "%s" INCLUDING DEFAULTS) PARTITION BY RANGE ("%s")' % (
+        new_table_name, table_name, PARTITION_KEY
+    ))
+    connection.execute('CREATE TABLE "%s" PARTITION OF "%s" DEFAULT' % (DEFAULT_PARTITION % table_name, new_table_name))
+    for season in sorted(seasons):
+        _create_season_partition(connection, table_name, season, parent_name=new_table_name)
+
+    connection.execute('INSERT INTO "%s" SELECT * FROM "%s"' % (new_table_name, table_name))
+    # Takes the foreign keys referring to it along.
+    connection.execute('DROP TABLE "%s" CASCADE' % table_name)
+    connection.execute('ALTER TABLE "%s" RENAME TO "%s"' % (new_table_name, table_name))
+    # The partition key must be part of the primary key, which it is.
+    connection.execute('ALTER TABLE "%s" ADD CONSTRAINT "%s_pkey" PRIMARY KEY (%s)' % (
+        table_name, table_name, ', '.join('"%s"' % column.name for column in table.primary_key)
+    ))
+    connection.execute('ANALYZE "%s"' % table_name)
+
+
+def ensure_partitions(connection, seasons=(), seasons_ahead=SEASONS_AHEAD):
+    """ Makes sure every partitioned archive-table has a partition for
+    each of `seasons`, the seasons of the rows in its default
+    partition, and the current season and `seasons_ahead` after it.
+
+    Does nothing to tables that aren't partitioned, so it can be used
+    on any mirror.
+    """
+    if not is_postgres(connection):
+        return
+
+    current_season = get_season(datetime.date.today())
+    seasons = set(seasons) | set(range(current_season, current_season + seasons_ahead + 1))
+
+    for table_name in PARTITIONED_TABLES:
+        if not is_partitioned(connection, table_name):
+            continue
+
+        partitions = get_partitions(connection, table_name)
+        for season in sorted(seasons | get_seasons(connection, DEFAULT_PARTITION % table_name)):
+            if SEASON_PARTITION % (table_name, season) not in partitions:
+                _create_season_partition(connection, table_name, season)
+
+
+def _create_season_partition(connection, table_name, season, parent_name=None):
+    """ Creates the partition of `season` of `table_name` (while it's
+    being partitioned, known as `parent_name`), with the rows of it
+    that ended up in the default partition in the meantime --- a
+    default partition with rows in the range of a new partition can't
+    stay.
+    """
+    parent_name = parent_name or table_name
+    partition_name = SEASON_PARTITION % (table_name, season)
+    default_partition = DEFAULT_PARTITION % table_name
+    start, end = get_season_range(season)
+    in_season = '"%s" >= \'%s\' AND "%s" < \'%s\'' % (PARTITION_KEY, start.isoformat(), PARTITION_KEY, end.isoformat())
+
+    logger.info('Creating partition "%s"' % partition_name)
+    connection.execute('CREATE TABLE "%s" (LIKE "%s" INCLUDING DEFAULTS)' % (partition_name, parent_name))
+    moved = connection.execute('''
+        WITH moved AS (DELETE FROM "%s" WHERE %s RETURNING *)
+        INSERT INTO "%s" SELECT * FROM moved
+    ''' % (default_partition, in_season, partition_name)).rowcount
+    if moved:
+        logger.info('Moved %i rows from "%s" to "%s"' % (moved, default_partition, partition_name))
+    # The indexes and primary key of the table are added to the partition as it's attached.
+    connection.execute('ALTER TABLE "%s" ATTACH PARTITION "%s" FOR VALUES FROM (\'%s\') TO (\'%s\')' % (
+        parent_name, partition_name, start.isoformat(), end.isoformat()
+    ))
+
+
+def manage(connection, seasons_ahead=SEASONS_AHEAD):
+    if connection.dialect.server_version_info < MINIMUM_SERVER_VERSION:
+        raise ValueError('Partitioning the mirror needs Postgres %s or newer' % '.'.join(str(part) for part in MINIMUM_SERVER_VERSION))
+
+    model.Base.metadata.create_all(bind=connection)
+    model.create_mirror_tables(connection)
+
+    for table_name in PARTITIONED_TABLES:
+        if not is_partitioned(connection, table_name):
+            current_season = get_season(datetime.date.today())
+            partition_table(connection, table_name, range(current_season, current_season + seasons_ahead + 1))
+    ensure_partitions(connection, seasons_ahead=seasons_ahead)
+
+    # On the partitioned tables, these end up on every partition.
+    ensure_indexes(connection)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Creates the indexes and partitions of the Postgres-mirror.')
+    parser.add_argument('-c', '--conf', metavar='config_file.yaml', help='The configuration with the engine of the mirror.')
+    parser.add_argument('-e', '--engine', default='jr', help='The name of the engine of the mirror in the configuration. (default: "jr")')
+    parser.add_argument('--url', help='SQLAlchemy-URL of the mirror, instead of a configuration.')
+    parser.add_argument('--seasons-ahead', type=int, default=SEASONS_AHEAD,
+                        help='Number of seasons after the current to make partitions for. (default: %i)' % SEASONS_AHEAD)
+    options = parser.parse_args()
+
+    url = options.url
+    if not url:
+        if not options.conf:
+            parser.error('either --conf or --url is required')
+        configuration = conf.ConfigurationManager()
+        configuration.load_from_file(options.conf)
+        url = configuration.get('database.engines.%s.engine.url' % options.engine)
+        if not url:
+            parser.error('there is no engine "%s" in %s' % (options.engine, options.conf))
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    started_at = time.time()
+    engine = sa.create_engine(url)
+    # All or nothing: DDL is transactional in Postgres.
+    with engine.begin() as connection:
+        manage(connection, options.seasons_ahead)
+    logger.info('Done in %.1fs' % (time.time() - started_at))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,24 @@
+import collections
+import contextlib
+import copy
 import datetime
 import functools
+import logging
+import threading
+import time
 
 from sqlalchemy import orm, event
 from sqlalchemy.orm import attributes
 from sqlalchemy.ext import declarative
 from sqlalchemy.ext.declarative import declared_attr
-from twisted.internet import defer, threads
+from twisted.internet import defer
 import sqlalchemy as sa
 
+from jr import ids, profiling, workers
+
+
+logger = logging.getLogger('jr')
+
 
 class _Base(object):
 
@@ -28,27 +39,175 @@ class _Base(object):
 
     json_attributes = tuple()
     json_relations = tuple()
+    # Columns the properties in json_attributes are computed from.
+    json_columns = tuple()
 
     def __json__(self):
-        return dict((key, getattr(self, key)) for key in self.json_attributes + self.json_relations
-                    if self.is_loaded(key))
+        return get_json_serializers(type(self))[0](self)
 
     def __circular_json__(self):
-        return dict((key, getattr(self, key)) for key in self.json_attributes if self.is_loaded(key))
+        return get_json_serializers(type(self))[1](self)
 
     def get_next_id(self, column=None):
         if column is None:
             column = list(self.__table__.primary_key)[0]
-        return (self.session.execute(sa.select([sa.func.max(column)])).scalar() or 0) + 1
+        return ids.allocate(self.session, column)
 
 
 Base = declarative.declarative_base(cls=_Base)
 
+# Tables that only exist in the Postgres-mirror maintained by the
+# sync-server. They're kept out of Base.metadata, as everything there
+# is assumed to be a JumpRun-table with a corresponding audit-table.
+MirrorBase = declarative.declarative_base(cls=_Base)
+
+
+_json_serializers = dict()
+
+
+def get_json_serializers(Class):
+    """ Returns the functions that serialize instances of `Class` to
+    dicts for the JSON-encoder, compiling them first if needed.
+
+    The first one includes `json_attributes` and `json_relations`, and
+    is used the first time an object is encoded. The second one, used
+    for objects we've already seen, only includes `json_attributes`.
+
+    Like before, only attributes and relations that are already loaded
+    are included, so serializing never causes lazy loads.
+    """
+    try:
+        return _json_serializers[Class]
+    except KeyError:
+        serializers = _json_serializers[Class] = (
+            _compile_json_serializer(Class, Class.json_attributes + Class.json_relations),
+            _compile_json_serializer(Class, Class.json_attributes)
+        )
+        return serializers
+
+
+def compile_json_serializers():
+    """ Compiles the serializers of every mapped class up front. """
+    orm.configure_mappers()
+    for Class in Base._decl_class_registry.values() + MirrorBase._decl_class_registry.values():
+        if isinstance(Class, type) and issubclass(Class, _Base):
+            get_json_serializers(Class)
+
+
+_json_only_options = dict()
+
+
+def json_only(Class, path=''):
+    """ Returns query-options that defer the columns of `Class` which
+    its JSON doesn't need, for read-only queries. `path` is the
+    relation leading to `Class`, e.g. "manifests.invoices".
+
+    Primary and foreign keys are always loaded, as are the
+    `json_columns`. The serializers only include loaded attributes, so
+    the deferred columns are never loaded.
+    """
+    key = Class, path
+    if key not in _json_only_options:
+        needed = set(Class.json_attributes + Class.json_columns)
+        prefix = path + '.' if path else ''
+
+        options = []
+        for prop in orm.class_mapper(Class).column_attrs:
+            column = prop.columns[0]
+            if prop.key in needed or column.primary_key or column.foreign_keys:
+                continue
+            options.append(orm.defer(prefix + prop.key))
+
+        _json_only_options[key] = options
+    return _json_only_options[key]
+
+
+def _compile_json_serializer(Class, keys):
+    # Loaded attributes are the ones in the instance's __dict__, which is
+    # a lot cheaper to check than going through the instance state.
+    mapped_keys = set(prop.key for prop in orm.class_mapper(Class).iterate_properties)
+
+    lines = ['def serialize(obj):', '    d = obj.__dict__', '    result = dict()']
+    for key in keys:
+        if key in mapped_keys:
+            lines.append('    if %r in d: result[%r] = d[%r]' % (key, key, key))
+        elif hasattr(Class, key):
+            # Plain properties. They're left out if they fail, e.g. on unknown JumpRun-codes.
+            lines.append('    try: result[%r] = obj.%s' % (key, key))
+            lines.append('    except Exception: pass')
+    lines.append('    return result')
+
+    namespace = dict()
+    exec(compile('\n'.join(lines), '<json serializer for %s>' % Class.__name__, 'exec'), namespace)
+    return namespace['serialize']
+
 
 Decimal = lambda: sa.Numeric(precision=12, scale=2)
 Money = Decimal
 
 
+# Compiled SQL for the statements of the cached queries, shared by every engine.
+_compiled_cache = sa.util.LRUCache(500)
+_compiled_contexts = dict()
+
+
+class Query(orm.Query):
+    """ Query that, once baked, compiles itself only once per process.
+
+    SQLAlchemy 0.8 has no baked queries, so this does what its recipe
+    did: the compiled context (the SELECT with every join of the eager
+    loads) of a baked query is cached, and copied for every execution.
+    Its SQL is compiled once too, by way of the `compiled_cache`.
+
+    Only the values of `sa.bindparam`s may vary between the executions
+    of a baked query --- which is why you want `cached_query`.
+    """
+    _bake_key = None
+    _baked_shape = None
+
+    def bake(self, key):
+        query = self.execution_options(compiled_cache=_compiled_cache)
+        query._bake_key = key
+        query._baked_shape = query._criterion, query._order_by
+        return query
+
+    def _is_baked(self):
+        # Anything filtered or ordered after baking is a different query.
+        return self._bake_key is not None and self._baked_shape[0] is self._criterion and self._baked_shape[1] is self._order_by
+
+    def _compile_context(self, labels=True):
+        if not self._is_baked():
+            return super(Query, self)._compile_context(labels)
+
+        # Slicing, as done by .first(), is fine.
+        key = self._bake_key, self._limit, self._offset, labels
+        if key not in _compiled_contexts:
+            _compiled_contexts[key] = super(Query, self)._compile_context(labels)
+
+        context = copy.copy(_compiled_contexts[key])
+        context.query = self
+        context.session = self.session
+        context.attributes = context._attributes = context.attributes.copy()
+        return context
+
+
+def cached_query(build):
+    """ Decorator for functions that build a query without a session,
+    whose varying values are `sa.bindparam`s. The query is built and
+    baked once per distinct set of arguments, which should be the
+    ones that decide its shape. Bind it with `with_session` and
+    `params`.
+    """
+    queries = dict()
+
+    @functools.wraps(build)
+    def wrapper(*args):
+        if args not in queries:
+            queries[args] = build(*args).bake((build.__module__, build.__name__) + args)
+        return queries[args]
+    return wrapper
+
+
 class _Session(orm.Session):
 
     def __enter__(self):
@@ -60,71 +219,255 @@ class _Session(orm.Session):
 
 Session = orm.sessionmaker(
     expire_on_commit=False,
-    class_=_Session
+    class_=_Session,
+    query_cls=Query
 )
 
 
 
+def _get_change(obj, key):
+    history = attributes.get_history(obj, key)
+    return sum(value or 0 for value in history.added) - sum(value or 0 for value in history.deleted)
+
+
+def _get_customer_key(obj):
+    # The customer if it's loaded (a new invoice may not have its customer_id until flushed), or else the id.
+    customer = obj.__dict__.get('customer')
+    if customer is not None:
+        return customer
+    return obj.customer_id
+
+
+def adjust_balances(session, deltas):
+    """ Adds the amounts in `deltas` to the balances of the customers
+    they're keyed by --- either a `Customer` or a customer id.
+
+    Customers in the session are adjusted as objects, and flushed along
+    with everything else. The rest are adjusted with one executemany'd
+    UPDATE, so they don't have to be loaded first.
+    """
+    now = datetime.datetime.now()
+    to_update = []
+
+    for key, delta in deltas.items():
+        if not delta or key is None:
+            continue
+
+        customer = key
+        if not isinstance(key, Customer):
+            customer = session.identity_map.get(orm.util.identity_key(Customer, key))
+
+        if customer is not None:
+            customer.balance += delta
+            customer.last_modified = now
+        else:
+            to_update.append(dict(_customer_id=key, _delta=delta))
+
+    if to_update:
+        columns = Customer.__table__.c
+        session.execute(
+            Customer.__table__.update().
+            where(columns.wCustId == sa.bindparam('_customer_id')).
+            values(cTotBal=columns.cTotBal + sa.bindparam('_delta'), dtUpdate=now),
+            to_update
+        )
+
+
 def maintain_balances(session):
+    deltas = collections.defaultdict(int)
+
     for inserted in session.new:
         if isinstance(inserted, Invoice):
-            inserted.customer.balance += inserted.price
+            deltas[_get_customer_key(inserted)] += inserted.price or 0
         elif isinstance(inserted, Payment):
-            inserted.customer.balance -= inserted.amount
+            deltas[_get_customer_key(inserted)] -= inserted.amount or 0
 
     for deleted in session.deleted:
         if isinstance(deleted, Invoice):
-            deleted.customer.balance -= deleted.price
+            deltas[_get_customer_key(deleted)] -= deleted.price or 0
         elif isinstance(deleted, Payment):
-            deleted.customer.balance += deleted.amount
+            deltas[_get_customer_key(deleted)] += deleted.amount or 0
 
     for dirty in session.dirty:
+        # If the price/amount changed, update the balance accordingly
         if isinstance(dirty, Invoice):
-            # If the price changed, update the balance accordingly
-            new, old = attributes.get_history(dirty, 'price').sum()
-            dirty.customer.balance += old - new
+            deltas[_get_customer_key(dirty)] += _get_change(dirty, 'price')
         elif isinstance(dirty, Payment):
-            dirty.customer.balance += old - new
+            deltas[_get_customer_key(dirty)] -= _get_change(dirty, 'amount')
 
         # TODO: Move this out of here. With authentication in place, we also want to know modified_by.
         if hasattr(dirty, 'last_modified'):
             dirty.last_modified = datetime.datetime.now()
 
+    adjust_balances(session, deltas)
 
-event.listen(Session, 'before_commit', maintain_balances)
 
+# Before every flush, and not just before the commit, as objects flushed by an earlier query are no longer new.
+event.listen(Session, 'before_flush', lambda session, flush_context, instances: maintain_balances(session))
 
-def with_session(method, timeout=None):
-    """ The wrapped method is invoked with an SQLALchemy session as
-    the first argument. Execution is also deferred to a thread.
+
+# Statements taking longer than this many seconds are logged along with their parameters.
+slow_statement_threshold = 0.5
+
+_statement_context = threading.local()
+
+
+class StatementStats(object):
+    """ Counts and times the statements executed on behalf of something,
+    such as a request, tagged with e.g. "ManifestHandler.POST".
     """
-    @functools.wraps(method)
-    @defer.inlineCallbacks
-    def wrapper(self, *args, **kwargs):
-        engine = yield self.engine_dependency.wait_for_resource(timeout)
-        with Session(bind=engine) as session:
-            defer.returnValue( (yield threads.deferToThread(method, self, session, *args, **kwargs)) )
-    return wrapper
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.count = 0
+        self.time = 0
+
+    def add(self, duration):
+        self.count += 1
+        self.time += duration
+
+
+# Aggregated per tag by `record_statement_stats`.
+statement_stats = dict()
+
+
+def record_statement_stats(stats):
+    logger.debug('%s executed %i statements in %.3fs' % (stats.tag, stats.count, stats.time))
+
+    aggregate = statement_stats.setdefault(stats.tag, dict(requests=0, statements=0, max_statements=0, time=0, max_time=0))
+    aggregate['requests'] += 1
+    aggregate['statements'] += stats.count
+    aggregate['max_statements'] = max(aggregate['max_statements'], stats.count)
+    aggregate['time'] += stats.time
+    aggregate['max_time'] = max(aggregate['max_time'], stats.time)
+
+
+@contextlib.contextmanager
+def counting_statements(stats):
+    """ Counts the statements executed by this thread towards `stats`. """
+    previous = getattr(_statement_context, 'stats', None)
+    _statement_context.stats = stats
+    try:
+        yield stats
+    finally:
+        _statement_context.stats = previous
+
+
+@event.listens_for(sa.engine.Engine, 'before_cursor_execute')
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('jr_statement_started_at', []).append(time.time())
 
 
-def with_session(method, timeout=10):
+@event.listens_for(sa.engine.Engine, 'after_cursor_execute')
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    duration = time.time() - connection.info['jr_statement_started_at'].pop()
+
+    stats = getattr(_statement_context, 'stats', None)
+    if stats is not None:
+        stats.add(duration)
+
+    if duration > slow_statement_threshold:
+        logger.warn('Slow statement (%.3fs) for %s: %s %r' % (duration, stats.tag if stats else 'unknown', statement, parameters))
+
+
+def get_change_summary(session, table, *criteria):
+    """ Returns a cheap summary of the rows in `table` matching
+    `criteria`, which changes whenever a row is inserted, updated or
+    deleted.
+
+    Useful as a version for ETags and for detecting changes, as long
+    as the table maintains dtInsert/dtUpdate.
+    """
+    columns = table.c
+    # The archive-tables also have dtProcess in their primary key.
+    id_column = [column for column in table.primary_key if isinstance(column.type, sa.Integer)][0]
+    query = sa.select([
+        sa.func.count(),
+        sa.func.max(columns.dtInsert),
+        sa.func.max(columns.dtUpdate),
+        sa.func.sum(id_column),
+    ])
+    if criteria:
+        query = query.where(sa.and_(*criteria))
+    return tuple(session.execute(query).first())
+
+
+def with_session(method, timeout=10, read_only=False):
     """ The wrapped method is invoked with an SQLALchemy session as
-    the first argument. Execution is also deferred to a thread.
+    the first argument. Execution is deferred to the engine's
+    `workers.WorkerPool`, which fails with a `TemporaryError` if the
+    engine is too busy. The statements executed are counted towards
+    the object's `statement_stats`, and the call is profiled if it has
+    a `profiler` (see `jr.profiling`).
+
+    With `read_only`, the session is bound to the object's
+    `read_engine_dependency` if it has one (i.e. the Postgres-mirror)
+    --- as long as it's available, and, if the object has a
+    `max_staleness`, no more than that many seconds behind JumpRun.
+    Otherwise, the regular engine is used.
     """
     @functools.wraps(method)
     @defer.inlineCallbacks
     def wrapper(self, *args, **kwargs):
-        engine = yield self.engine_dependency.wait_for_resource(timeout)
+        if self.engine_dependency.is_ready:
+            # What wait_for_resource would return, without its deferreds. Always the case once warmed up.
+            engine = self.engine_dependency.get_resource()
+        else:
+            engine = yield self.engine_dependency.wait_for_resource(timeout)
+
+        read_engine_dependency = getattr(self, 'read_engine_dependency', None)
+        if read_only and read_engine_dependency and read_engine_dependency.is_ready:
+            read_engine = yield read_engine_dependency.wait_for_resource(timeout)
+            if (yield is_fresh_enough(read_engine, getattr(self, 'max_staleness', None))):
+                engine = read_engine
 
-        @threads.deferToThread
         def _():
-            with Session(bind=engine) as session:
-                return method(self, session, *args, **kwargs)
+            with counting_statements(getattr(self, 'statement_stats', None)), profiling.profiling(getattr(self, 'profiler', None)):
+                with Session(bind=engine) as session:
+                    return method(self, session, *args, **kwargs)
 
-        defer.returnValue( (yield _) )
+        defer.returnValue( (yield workers.get_pool(engine).run(_)) )
     return wrapper
 
 
+def with_read_only_session(method, timeout=10):
+    return with_session(method, timeout, read_only=True)
+
+
+_sync_status_cache = dict()
+
+
+def is_fresh_enough(engine, max_staleness, cache_time=2):
+    """ Returns a deferred that fires with whether the mirror `engine`
+    was synced with JumpRun less than `max_staleness` seconds ago. The
+    sync-status is only looked up every `cache_time` seconds.
+    """
+    if max_staleness is None:
+        return defer.succeed(True)
+
+    def is_fresh(synced_at):
+        return synced_at is not None and (datetime.datetime.now() - synced_at).total_seconds() <= max_staleness
+
+    checked_at, synced_at = _sync_status_cache.get(engine, (None, None))
+    if checked_at and (datetime.datetime.now() - checked_at).total_seconds() <= cache_time:
+        return defer.succeed(is_fresh(synced_at))
+
+    def get_synced_at():
+        synced_at = engine.execute(
+            sa.select([SyncStatus.synced_at]).where(SyncStatus.name == SyncStatus.CHANGES)
+        ).scalar()
+        _sync_status_cache[engine] = datetime.datetime.now(), synced_at
+        return synced_at
+
+    def failed(failure):
+        # Say, the mirror is down. Then JumpRun it is, and we don't ask again for a while.
+        logger.warn('Could not get the sync-status of the mirror: %s' % failure.getErrorMessage())
+        _sync_status_cache[engine] = datetime.datetime.now(), None
+        return False
+
+    return workers.get_pool(engine).run(get_synced_at).addCallbacks(is_fresh, failed)
+
+
 class _CommonMixin:
 
     insertion_time = sa.Column('dtInsert', sa.DateTime, default=datetime.datetime.now)
@@ -135,6 +478,18 @@ class _CommonMixin:
     json_attributes = ('insertion_time', 'last_modified', 'inserted_by', 'updated_by')
 
 
+# The tConfig-entry with the current business date, which JumpRun stores as a string.
+BUSINESS_DAY_ID = 217
+BUSINESS_DAY_FORMAT = '%m/%d/%Y'
+
+
+def get_business_date(session):
+    value = session.execute(
+        sa.select([SystemConfiguration.value]).where(SystemConfiguration.configuration_id == BUSINESS_DAY_ID)
+    ).scalar()
+    return datetime.datetime.strptime(value, BUSINESS_DAY_FORMAT)
+
+
 class SystemConfiguration(Base):
     __tablename__ = 'tConfig'
 
@@ -276,6 +631,7 @@ class Manifest(Base, _ManifestMixin):
     plane = orm.relationship('Plane', uselist=False, backref='manifests')
 
     json_attributes = ('manifest_id', 'status', 'departure', 'load_number') + _CommonMixin.json_attributes
+    json_columns = ('_status', )
     json_relations = ('plane', 'invoices')
 
     def populate(self):
@@ -290,6 +646,7 @@ class Manifest(Base, _ManifestMixin):
         columns = self.__table__.c
         self.manifest_id = self.get_next_id()
         self.redundant_key = self.get_next_id(columns.nManiNo)
+        # Not an id: the loads are numbered per plane, and start over every day.
         self.load_number = (self.session.execute(sa.select([sa.func.max(columns.nLoad)]).where(columns.nPlaneId == self.plane.plane_id)).scalar() or 0) + 1
 
 
@@ -301,9 +658,14 @@ class ArchivedManifest(Base, _ManifestMixin):
     plane = orm.relationship('Plane', uselist=False, backref='archived_manifests')
 
     json_attributes = ('manifest_id', 'status', 'departure') + _CommonMixin.json_attributes
+    json_columns = ('_status', )
     json_relations = ('plane', 'archived_invoices')
 
 
+# The meaning of JumpRun's nPriceType.
+item_types = {1: 'jump', 3: 'jump_modifier', 4: 'counter_sale'}
+
+
 class Item(Base, _CommonMixin):
     __tablename__ = 'tPrices'
 
@@ -315,7 +677,7 @@ class Item(Base, _CommonMixin):
     _item_type = sa.Column('nPriceType', sa.BigInteger)
     @property
     def item_type(self):
-        return {1: 'jump', 3: 'jump_modifier', 4: 'counter_sale'}[self._item_type]
+        return item_types[self._item_type]
 
     is_active = sa.Column('bActive', sa.Boolean, default=True)
 
@@ -329,6 +691,7 @@ class Item(Base, _CommonMixin):
     _track_inventory = sa.Column('bTrackInventory', sa.Boolean, default=False)
 
     json_attributes = ('item_id', 'name', 'price', 'item_type') + _CommonMixin.json_attributes
+    json_columns = ('_item_type', )
 
 
 class _InvoiceMixin(_CommonMixin):
@@ -433,18 +796,55 @@ class _PaymentMixin(_CommonMixin):
         return {0: 'transfer', 1: 'cash', 2: 'check', 6: 'credit', 7: 'debit', 8: 'redemption'}.get(self._method, self._method)
 
     json_attributes = ('payment_id', 'comment', 'amount', 'transaction_type', 'method', 'business_date')
+    json_columns = ('_transaction_type', '_method')
     json_relations = ('customer', )
 
 
-class Payment(Base, _PaymentMixin):
+class Payment(_PaymentMixin, Base):
     __tablename__ = 'tPmt'
     customer_id = sa.Column('wCustId', sa.BigInteger, sa.ForeignKey('tPeople.wCustId'))
     customer = orm.relationship('Customer', backref='payments', uselist=False)
 
 
-class ArchivedPayment(Base, _PaymentMixin):
+class ArchivedPayment(_PaymentMixin, Base):
     __tablename__ = 'tPmtAll'
     business_date = sa.Column('dtProcess', sa.DateTime, primary_key=True)
 
     customer_id = sa.Column('wCustId', sa.BigInteger, sa.ForeignKey('tPeople.wCustId'))
     customer = orm.relationship('Customer', backref=orm.backref('archived_payments', order_by=sa.desc('dtProcess')), uselist=False)
+
+
+class CustomerMonthlyStats(MirrorBase):
+    """ Jumps, revenue and payments per customer and month, maintained
+    by `jr.rollup` as changes are applied to the mirror.
+    """
+    __tablename__ = 'customer_monthly_stats'
+
+    customer_id = sa.Column(sa.BigInteger, primary_key=True, autoincrement=False)
+    month = sa.Column(sa.DateTime, primary_key=True)
+    jumps = sa.Column(sa.BigInteger, nullable=False, default=0)
+    revenue = sa.Column(Money(), nullable=False, default=0)
+    payments = sa.Column(Money(), nullable=False, default=0)
+
+    json_attributes = ('month', 'jumps', 'revenue', 'payments')
+
+
+class SyncStatus(MirrorBase):
+    """ When the sync-server last brought the mirror up to date. """
+    __tablename__ = 'sync_status'
+
+    CHANGES = 'changes'
+
+    name = sa.Column(sa.Text, primary_key=True)
+    synced_at = sa.Column(sa.DateTime)
+
+    @classmethod
+    def mark_synced(cls, session, name=CHANGES):
+        table = cls.__table__
+        values = dict(synced_at=datetime.datetime.now())
+        if not session.execute(table.update(table.c.name == name).values(**values)).rowcount:
+            session.execute(table.insert().values(name=name, **values))
+
+
+def create_mirror_tables(bind):
+    MirrorBase.metadata.create_all(bind=bind)
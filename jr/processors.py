@@ -5,14 +5,14 @@ import re
 import sqlalchemy as sa
 from piped import log, processing, util
 from piped.processors import base as piped_base
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task
 from zope import interface
 
-from jr import base, model
+from jr import base, board, cluster, manifest, mirror, model, public, reference, rollup, suggest, warmup, workers
 
 
-BUSINESS_DAY_ID = 217
-DATE_FORMAT = '%m/%d/%Y'
+BUSINESS_DAY_ID = model.BUSINESS_DAY_ID
+DATE_FORMAT = model.BUSINESS_DAY_FORMAT
 
 # We'll be shipping a lot, sometimes.
 import twisted.spread.banana
@@ -71,10 +71,12 @@ class ChangeShipper(piped_base.Processor):
     name = 'ship-jr-changes'
     interface.classProvides(processing.IProcessor)
 
-    def __init__(self, method, input_path, **kw):
+    def __init__(self, method, input_path, ship_empty=False, **kw):
         super(ChangeShipper, self).__init__(**kw)
         self.method = method
         self.input_path = input_path
+        # Shipping nothing lets the receiver know it's still in sync.
+        self.ship_empty = ship_empty
 
     def configure(self, runtime_environment):
         self.client_dependency = runtime_environment.dependency_manager.add_dependency(self, dict(provider='pb.client.jrsync_client.root_object'))
@@ -82,7 +84,7 @@ class ChangeShipper(piped_base.Processor):
     @defer.inlineCallbacks
     def process(self, baton):
         data = util.dict_get_path(baton, self.input_path)
-        if data:
+        if data or (self.ship_empty and data is not None):
             yield self._ship_data(data)
         defer.returnValue(baton)
 
@@ -136,6 +138,9 @@ class ChangeApplier(base._DBProcessor):
         super(ChangeApplier, self).__init__(**kw)
         self.input_path = input_path
         self._primary_key_for_table = dict()
+        self._has_ensured_stats_tables = False
+        # Seasons we've made sure the partitioned archive-tables have partitions for.
+        self._ensured_seasons = set()
 
     @defer.inlineCallbacks
     def process(self, baton):
@@ -149,6 +154,13 @@ class ChangeApplier(base._DBProcessor):
     def _apply_changes(self, session, changes):
         tables = model.Base.metadata.tables
 
+        if not self._has_ensured_stats_tables:
+            rollup.ensure_tables(session.connection())
+            self._has_ensured_stats_tables = True
+        stats = rollup.StatsMaintainer(session)
+        # The partitions are made in this transaction, so they're only there once it's committed.
+        seasons = set()
+
         for table_name, changes_for_table in changes.items():
             table_name = table_name.replace('_audit', '')
 
@@ -166,20 +178,39 @@ class ChangeApplier(base._DBProcessor):
                 if table.name in ('tInv', 'tMani', 'tPmt'):
                     table = tables[table.name + 'All']
 
-                self._apply_row_in_table(row, table, session)
+                if table.name in mirror.PARTITIONED_TABLES:
+                    self._ensure_season(session, row['dtProcess'], seasons)
+
+                self._apply_row_in_table(row, table, session, stats)
 
             if changes_for_table:
                 logger.debug('Applied %i changes to "%s"' % (len(changes_for_table), table.name))
 
+        model.SyncStatus.mark_synced(session)
         session.commit()
+        self._ensured_seasons.update(seasons)
+
+    def _ensure_season(self, session, business_date, seasons):
+        # Rather than leaving the rows of a new season in the default partition.
+        season = mirror.get_season(business_date)
+        if season not in self._ensured_seasons and season not in seasons:
+            mirror.ensure_partitions(session.connection(), [season])
+            seasons.add(season)
 
-    def _apply_row_in_table(self, row, table, connection):
+    def _apply_row_in_table(self, row, table, connection, stats):
         where_clause = self._get_where_clause_for_table(table, row)
+        is_rolled_up = rollup.is_rolled_up(table)
 
         operation = row.pop('operation')
+        if is_rolled_up:
+            for existing_row in connection.execute(table.select(where_clause)):
+                stats.remove(table, existing_row)
+
         connection.execute(table.delete(where_clause))
         if operation in ('UPDATE', 'INSERT'):
             connection.execute(table.insert(row))
+            if is_rolled_up:
+                stats.add(table, row)
 
     def _get_where_clause_for_table(self, table, row):
         return sa.and_(*(column == row[column.name] for column in table.primary_key))
@@ -227,10 +258,17 @@ class TableRestorer(base._DBProcessor):
 
     @model.with_session
     def _truncate_and_restore_tables(self, session, table_data):
-        for table_name in model.Base.metadata.tables:
-            session.execute('TRUNCATE "%s"' % table_name)
+        model.create_mirror_tables(session.connection())
+        # All at once, as tables referred to by foreign keys can't be truncated by themselves.
+        session.execute('TRUNCATE %s' % ', '.join('"%s"' % table_name for table_name in model.Base.metadata.tables))
 
         self._restore_tables(session, table_data)
+        # The restored archive goes into the default partitions, if they're partitioned.
+        mirror.ensure_partitions(session.connection())
+
+        logger.info('Rebuilding customer statistics')
+        rollup.rebuild(session.connection())
+        model.SyncStatus.mark_synced(session)
 
         session.commit()
 
@@ -275,3 +313,159 @@ class TableRestorer(base._DBProcessor):
                 session.execute(table.insert(row))
 
 
+class BoardChangeChecker(base._DBProcessor):
+    """ Detects changes to the departure board done outside of our
+    handlers, i.e. directly in JumpRun, and bumps the version of the
+    board so waiting viewers get updated.
+
+    This is a handful of aggregates per tick, no matter how many
+    viewers are waiting for the board to change. It also keeps
+    `reference.data` up to date.
+
+    In a cluster, only one of the workers checks, and tells the others.
+    """
+    name = 'check-board-changes'
+    interface.classProvides(processing.IProcessor)
+
+    @defer.inlineCallbacks
+    def process(self, baton):
+        if not cluster.is_primary():
+            defer.returnValue(baton)
+        board.watcher.update_fingerprint((yield self._get_fingerprint()))
+        defer.returnValue(baton)
+
+    @model.with_session
+    def _get_fingerprint(self, session):
+        # The board includes the items and planes, so check them here too.
+        reference.data.refresh(session, force=True)
+        fingerprint = reference.data.version
+        for Class in (model.Manifest, model.Invoice, model.Payment):
+            fingerprint += model.get_change_summary(session, Class.__table__)
+        return fingerprint
+
+
+class PublicBoardPublisher(base._DBProcessor):
+    """ Writes the public departure board to static files whenever the
+    board has changed, so the public site doesn't have to query.
+
+    Cheap when nothing has changed, so run it often. In a cluster,
+    only one of the workers publishes.
+    """
+    name = 'publish-public-board'
+    interface.classProvides(processing.IProcessor)
+
+    def __init__(self, directory='public/board', keep=10, **kw):
+        super(PublicBoardPublisher, self).__init__(**kw)
+        self.writer = public.BoardWriter(directory, keep)
+        self.published_version = None
+
+    @defer.inlineCallbacks
+    def process(self, baton):
+        # Get the version before querying, so a change while we query results in another publish.
+        version = '%i-%i' % (board.watcher.epoch, board.watcher.version)
+        if cluster.is_primary() and version != self.published_version:
+            yield self._publish(version)
+            self.published_version = version
+        defer.returnValue(baton)
+
+    @model.with_session
+    def _publish(self, session, version):
+        self.writer.write(version, manifest.get_planes(session))
+
+
+class WarmUp(base._DBProcessor):
+    """ Does what the first requests after a start would otherwise
+    have to do, and marks the process as ready when done (see
+    `jr.warmup`). Meant to be run once, at startup.
+
+    The cyclone-sites named by `gated_sites` accept no connections
+    until then. Run at startup, that's before the first is accepted.
+    Only name the sites that need the warm-up, so the others --- the
+    public site, or the one with `/ready` --- stay up if it never
+    finishes.
+
+    If a database can't be reached, it tries again every
+    `retry_delay` seconds, and the process stays unready meanwhile.
+    """
+    name = 'warm-up'
+    interface.classProvides(processing.IProcessor)
+
+    def __init__(self, retry_delay=10, gated_sites=(), **kw):
+        super(WarmUp, self).__init__(**kw)
+        self.retry_delay = retry_delay
+        self.gated_sites = gated_sites
+
+    def configure(self, runtime_environment):
+        super(WarmUp, self).configure(runtime_environment)
+        self.site_dependencies = [
+            runtime_environment.dependency_manager.add_dependency(self, dict(provider='cyclone.application.%s' % site))
+            for site in self.gated_sites
+        ]
+
+    @defer.inlineCallbacks
+    def process(self, baton):
+        readiness = warmup.readiness
+        ports = []
+        if not readiness.is_ready:
+            applications = []
+            for dependency in self.site_dependencies:
+                applications.append((yield dependency.wait_for_resource()))
+            ports = warmup.stop_accepting(applications)
+
+        while not readiness.is_ready:
+            readiness.start()
+            try:
+                yield self._warm_up(readiness)
+            except Exception as e:
+                readiness.failed(e)
+                yield task.deferLater(reactor, self.retry_delay, lambda: None)
+            else:
+                readiness.ready()
+        warmup.start_accepting(ports)
+        defer.returnValue(baton)
+
+    @defer.inlineCallbacks
+    def _warm_up(self, readiness):
+        readiness.step('database')
+        engine = yield self.engine_dependency.wait_for_resource()
+        # Not served by every process, such as the sync-server.
+        has_suggest = hasattr(suggest.SuggestHandler, 'engine_dependency')
+        suggest_engine = (yield suggest.SuggestHandler.get_index_engine()) if has_suggest else engine
+
+        readiness.step('mappers')
+        model.compile_json_serializers()
+
+        readiness.step('connections')
+        for engine_ in set([engine, suggest_engine]):
+            yield workers.get_pool(engine_).run(self._connect, engine_)
+
+        readiness.step('board')
+        yield self._run_hot_queries()
+
+        if has_suggest:
+            readiness.step('suggest')
+            yield suggest.SuggestHandler.build_index(suggest_engine)
+
+    def _connect(self, engine):
+        # As many as the pool keeps open, checked out at once so they're all opened.
+        number_of_connections = engine.pool.size() if hasattr(engine.pool, 'size') else 1
+        connections = [engine.connect() for i in range(number_of_connections)]
+        try:
+            for connection in connections:
+                connection.scalar(sa.select([1]))
+        finally:
+            for connection in connections:
+                connection.close()
+
+    @model.with_session
+    def _run_hot_queries(self, session):
+        """ Loads the reference data and the board, and runs the cached
+        queries once, so they're compiled.
+        """
+        reference.data.refresh(session, force=True)
+        base.encode_json(manifest.get_planes(session))
+        # Ids that are there (to get the per-plane and per-manifest queries) but match nothing.
+        manifest.get_planes(session, plane_id=-1)
+        manifest.get_planes(session, plane_id=-1, manifest_id=-1)
+        manifest._get_manifest_query().with_session(session).params(manifest_id=-1, plane_id=-1).first()
+        manifest._get_customer_item_query().with_session(session).params(existing_item_id=-1, customer_id=-1, manifest_id=-1, plane_id=-1).first()
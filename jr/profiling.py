@@ -0,0 +1,68 @@
+""" Opt-in profiling of single requests and pipeline runs.
+
+The interesting work happens in the worker threads of
+`model.with_session`, which the profiler of the reactor thread would
+never see. So every `with_session`-call made on behalf of something
+with a `profiler` is profiled in its thread, and the results are
+merged into one pstats-file, which can be inspected with e.g.
+`python -m pstats <file>`.
+"""
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import threading
+import time
+
+
+logger = logging.getLogger('jr')
+
+
+class Profile(object):
+    """ Collects the profiles of one request or pipeline run. """
+
+    def __init__(self, name):
+        self.name = name
+        self.stats = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def profiling(self):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            with self._lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profiler)
+                else:
+                    self.stats.add(profiler)
+
+    def save(self, directory):
+        """ Writes the collected profile to `directory`, and returns the
+        filename --- or None if nothing was profiled.
+        """
+        if self.stats is None:
+            return None
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        filename = os.path.join(directory, '%s-%s-%i.pstats' % (self.name, time.strftime('%Y%m%d-%H%M%S'), id(self)))
+        self.stats.dump_stats(filename)
+        logger.info('Stored profile of %s in %s' % (self.name, filename))
+        return filename
+
+
+@contextlib.contextmanager
+def profiling(profile):
+    """ Profiles the block towards `profile`, unless it's None. """
+    if profile is None:
+        yield
+        return
+
+    with profile.profiling():
+        yield
@@ -0,0 +1,125 @@
+""" The departure board of the public site, as static files.
+
+Anyone can watch the public board, so it must not cost us a query
+per viewer. Instead, the `publish-public-board`-processor renders the
+board to `<directory>/<version>.json` whenever it changes, and points
+to it from `<directory>/current.json`. Viewers poll the small pointer
+and fetch the version it names, which never changes and can be
+cached forever. The versions are gzipped up front too.
+
+Only what the viewers show is published: no balances, no comments.
+Whether someone is (soon) owing money is published as their
+`standing`.
+"""
+import json
+import os
+import tempfile
+
+from jr import assets, base
+
+
+POINTER_FILENAME = 'current.json'
+
+# What is public, per level of the board.
+PLANE_ATTRIBUTES = ('plane_id', 'name', 'capacity', 'is_active')
+MANIFEST_ATTRIBUTES = ('manifest_id', 'load_number', 'departure', 'status')
+INVOICE_ATTRIBUTES = ('invoice_id', 'manifest_id', 'customer_id', 'quantity')
+CUSTOMER_ATTRIBUTES = ('customer_id', 'name')
+ITEM_ATTRIBUTES = ('item_id', 'name', 'item_type', 'price')
+
+
+def get_standing(customer, item):
+    """ Returns 'owing' if the customer owes us money, 'soon-owing' if
+    they can't afford another `item`, and None otherwise.
+    """
+    balance = customer.balance or 0
+    if balance > 0:
+        return 'owing'
+    if item.price is not None and -balance < item.price:
+        return 'soon-owing'
+    return None
+
+
+def _pick(obj, attributes):
+    return dict((attribute, getattr(obj, attribute)) for attribute in attributes)
+
+
+def make_public(planes):
+    """ Returns the public subset of the loaded departure board. """
+    public_planes = []
+    for plane in planes:
+        public_plane = _pick(plane, PLANE_ATTRIBUTES)
+        public_plane['manifests'] = []
+        public_planes.append(public_plane)
+
+        for manifest in plane.manifests:
+            public_manifest = _pick(manifest, MANIFEST_ATTRIBUTES)
+            public_manifest['invoices'] = []
+            public_plane['manifests'].append(public_manifest)
+
+            for invoice in manifest.invoices:
+                public_invoice = _pick(invoice, INVOICE_ATTRIBUTES)
+                public_invoice['customer'] = _pick(invoice.customer, CUSTOMER_ATTRIBUTES)
+                public_invoice['customer']['standing'] = get_standing(invoice.customer, invoice.item)
+                public_invoice['item'] = _pick(invoice.item, ITEM_ATTRIBUTES)
+                public_manifest['invoices'].append(public_invoice)
+
+    return public_planes
+
+
+class BoardWriter(object):
+    """ Writes versions of the public board to `directory`, keeping
+    the `keep` latest, so viewers that just read the pointer still
+    find the version it named.
+    """
+
+    def __init__(self, directory, keep=10, compression_level=9):
+        self.directory = directory
+        self.keep = keep
+        self.compression_level = compression_level
+        self._written = None
+
+    def write(self, version, planes):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        if self._written is None:
+            # Left behind by an earlier process, oldest first.
+            self._written = sorted((filename for filename in os.listdir(self.directory)
+                                    if filename.endswith('.json') and filename != POINTER_FILENAME),
+                                   key=lambda filename: os.path.getmtime(os.path.join(self.directory, filename)))
+
+        filename = '%s.json' % version
+        encoded = base.encode_json(dict(ok=True, version=version, planes=make_public(planes)))
+        # The gzipped one first, so it's there for whoever finds the other.
+        self._write_file(filename + '.gz', base.gzip_encode(encoded, self.compression_level))
+        self._write_file(filename, encoded)
+        # Only point to the new version once it's all there.
+        self._write_file(POINTER_FILENAME, json.dumps(dict(version=version, filename=filename)))
+
+        self._written.append(filename)
+        while len(self._written) > self.keep:
+            filename = os.path.join(self.directory, self._written.pop(0))
+            for path in (filename, filename + '.gz'):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def _write_file(self, filename, data):
+        # Viewers must never see half a file, so write it elsewhere and rename it into place.
+        fd, temporary_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(temporary_path, 0o644)
+        os.rename(temporary_path, os.path.join(self.directory, filename))
+
+
+class BoardFileHandler(assets.StaticFileHandler):
+    """ Serves the files of the `BoardWriter`: the versions are cached
+    forever, the pointer only for `pointer_max_age` seconds.
+    """
+    pointer_max_age = 2
+
+    def get_max_age(self, path):
+        if os.path.basename(path) == POINTER_FILENAME:
+            return self.pointer_max_age
+        return self.CACHE_MAX_AGE
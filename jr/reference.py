@@ -0,0 +1,124 @@
+""" Process-wide cache of the reference-data: the items (tPrices) and
+the planes (tPlane).
+
+They change a few times per season, yet adding a jumper used to look
+up the item, and every board response joined in and serialized the
+item of every invoice. Instead, we keep detached snapshots of every
+item and plane, along with their serialized form, and reload them all
+when the change summary of either table changes.
+
+The snapshots must not be modified. To use one with a session, get
+it through `get_item`/`get_plane`, which merge it into the session
+without querying.
+
+The workers of a cluster tell each other when they have reloaded, so
+the others check sooner than they otherwise would.
+"""
+import threading
+import time
+
+from sqlalchemy.orm import attributes
+
+from jr import cluster, model
+
+
+class ReferenceData(object):
+    # How often `refresh` actually checks the tables, at most.
+    check_interval = 10
+
+    def __init__(self):
+        self.version = None
+        self.items = dict()
+        self.planes = dict()
+        self._json = dict()
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def refresh(self, session, force=False):
+        """ Reloads the snapshots if the tables have changed since the
+        last time we checked --- which is at most `check_interval`
+        seconds ago, unless `force` is given.
+
+        The lock only guards the bookkeeping: the queries run without
+        it, so nobody waits for our queries to get a connection.
+        """
+        with self._lock:
+            if not force and time.time() - self._checked_at < self.check_interval:
+                return
+            # The others needn't check while we do.
+            self._checked_at = time.time()
+
+        version = (
+            model.get_change_summary(session, model.Item.__table__) +
+            model.get_change_summary(session, model.Plane.__table__)
+        )
+        if version == self.version:
+            return
+
+        items, planes, json = self._load(session)
+        with self._lock:
+            self.items, self.planes, self._json, self.version = items, planes, json, version
+        cluster.publish('reference')
+
+    def invalidate(self):
+        """ Makes the next `refresh` check the tables. """
+        self._checked_at = 0
+
+    def _load(self, session):
+        # A session of our own, as expunging would detach the objects of the caller's session. It uses the
+        # caller's connection, as the pool may well have none to spare.
+        with model.Session(bind=session.connection()) as own_session:
+            items = dict((item.item_id, item) for item in own_session.query(model.Item))
+            planes = dict((plane.plane_id, plane) for plane in own_session.query(model.Plane))
+            own_session.expunge_all()
+
+        serialize_item = model.get_json_serializers(model.Item)[0]
+        return items, planes, dict((item, serialize_item(item)) for item in items.values())
+
+    def get_item(self, session, item_id):
+        """ Returns the item with `item_id` merged into `session`, or
+        None if there is no such item.
+        """
+        return self._get(session, model.Item, 'items', item_id)
+
+    def get_plane(self, session, plane_id):
+        return self._get(session, model.Plane, 'planes', plane_id)
+
+    def _get(self, session, Model, snapshots, id):
+        self.refresh(session)
+        if id not in getattr(self, snapshots):
+            # Must be brand new.
+            self.refresh(session, force=True)
+        if id not in getattr(self, snapshots):
+            # Not in the snapshots we got, which may be older than what's committed by now.
+            return session.query(Model).get(id)
+        return self._merge(session, getattr(self, snapshots)[id])
+
+    def _merge(self, session, snapshot):
+        if snapshot is None:
+            return None
+        return session.merge(snapshot, load=False)
+
+    def set_items(self, session, invoices):
+        """ Sets the item of every invoice to its snapshot, for
+        read-only use such as serializing. This avoids having to load
+        the item of every invoice.
+        """
+        self.refresh(session)
+        if any(invoice.item_id not in self.items for invoice in invoices):
+            # Must be a brand new item.
+            self.refresh(session, force=True)
+
+        for invoice in invoices:
+            if invoice.item_id in self.items:
+                attributes.set_committed_value(invoice, 'item', self.items[invoice.item_id])
+
+    def get_json(self, obj):
+        """ Returns the serialized form of `obj` if it's a snapshot, and
+        None otherwise.
+        """
+        return self._json.get(obj)
+
+
+data = ReferenceData()
+cluster.subscribe('reference', lambda message: data.invalidate())
@@ -0,0 +1,206 @@
+""" End-of-day numbers: loads flown per plane, jumpers per load and
+revenue by item type, per business date.
+
+The numbers for a date range are aggregated by the database from the
+archive-tables, and only the (small) grouped results are brought into
+Python. Once a business date is closed its numbers can't change, so
+they're cached on disk, and a season-long report only has to query
+the days it hasn't seen before.
+
+Like the rest of the API, amounts are multiplied by 100.
+"""
+import collections
+import datetime
+import json
+import logging
+import os
+
+import sqlalchemy as sa
+from twisted.internet import defer
+
+from jr import base, model, validation, exceptions
+
+
+logger = logging.getLogger('jr')
+
+# Bump when the contents of a day changes, so the cached days are recomputed.
+REPORT_VERSION = 1
+
+
+class DayCache(object):
+    """ Keeps the reports of closed business dates, in memory and as a
+    JSON-file per date in `directory`.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._days = dict()
+
+    def get(self, business_date):
+        if business_date not in self._days:
+            try:
+                with open(self._get_filename(business_date)) as file:
+                    self._days[business_date] = json.load(file)
+            except IOError:
+                return None
+        return self._days[business_date]
+
+    def put(self, business_date, day):
+        self._days[business_date] = day
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        # Write and rename, so a crash never leaves half a day behind.
+        filename = self._get_filename(business_date)
+        with open(filename + '.tmp', 'w') as file:
+            json.dump(day, file)
+        os.rename(filename + '.tmp', filename)
+
+    def _get_filename(self, business_date):
+        return os.path.join(self.directory, 'day-%s-v%i.json' % (business_date.strftime('%Y-%m-%d'), REPORT_VERSION))
+
+
+def _make_numbers():
+    return dict(
+        loads=0, jumpers=0, revenue=0,
+        planes=dict(),
+        jumpers_per_load=dict(),
+        revenue_by_item_type=dict(),
+    )
+
+
+def _make_day(business_date):
+    day = _make_numbers()
+    day['business_date'] = business_date.strftime('%Y-%m-%d')
+    return day
+
+
+def compute_days(connection, start, end):
+    """ Returns the report for every business date in [start, end] that
+    has any activity, using two grouped queries for the whole range.
+    """
+    days = dict()
+
+    def get_day(business_date):
+        if business_date not in days:
+            days[business_date] = _make_day(business_date)
+        return days[business_date]
+
+    invoices = model.ArchivedInvoice.__table__.c
+    manifests = model.ArchivedManifest.__table__.c
+    items = model.Item.__table__.c
+    in_range = sa.and_(invoices.dtProcess >= start, invoices.dtProcess <= end)
+
+    # One row per load, with its number of jumpers.
+    loads = connection.execute(
+        sa.select([invoices.dtProcess, manifests.nPlaneId, sa.func.count()]).
+        select_from(
+            model.ArchivedInvoice.__table__.
+            join(model.Item.__table__, items.wItemId == invoices.wItemId).
+            join(model.ArchivedManifest.__table__, sa.and_(manifests.dtProcess == invoices.dtProcess, manifests.nMani == invoices.nMani))
+        ).
+        where(in_range).
+        where(items.nPriceType == 1).
+        group_by(invoices.dtProcess, manifests.nPlaneId, invoices.nMani)
+    )
+    for business_date, plane_id, jumpers in loads:
+        day = get_day(business_date)
+        plane = day['planes'].setdefault(str(plane_id), dict(loads=0, jumpers=0))
+        plane['loads'] += 1
+        plane['jumpers'] += jumpers
+        day['loads'] += 1
+        day['jumpers'] += jumpers
+        day['jumpers_per_load'][str(jumpers)] = day['jumpers_per_load'].get(str(jumpers), 0) + 1
+
+    revenue = connection.execute(
+        sa.select([invoices.dtProcess, items.nPriceType, sa.func.sum(invoices.cPrice)]).
+        select_from(model.ArchivedInvoice.__table__.outerjoin(model.Item.__table__, items.wItemId == invoices.wItemId)).
+        where(in_range).
+        group_by(invoices.dtProcess, items.nPriceType)
+    )
+    for business_date, item_type, amount in revenue:
+        day = get_day(business_date)
+        amount = int(100 * (amount or 0))
+        item_type = model.item_types.get(item_type, str(item_type))
+        day['revenue_by_item_type'][item_type] = day['revenue_by_item_type'].get(item_type, 0) + amount
+        day['revenue'] += amount
+
+    return days
+
+
+def summarize(days):
+    total = _make_numbers()
+
+    for day in days:
+        for key in ('loads', 'jumpers', 'revenue'):
+            total[key] += day[key]
+        for plane_id, plane in day['planes'].items():
+            total_for_plane = total['planes'].setdefault(plane_id, dict(loads=0, jumpers=0))
+            total_for_plane['loads'] += plane['loads']
+            total_for_plane['jumpers'] += plane['jumpers']
+        for key in ('jumpers_per_load', 'revenue_by_item_type'):
+            counter = collections.Counter(total[key])
+            counter.update(day[key])
+            total[key] = dict(counter)
+
+    return total
+
+
+class DailyReportHandler(base.Handler):
+    """ Returns the daily numbers for every business date between
+    `start` and `end` (both YYYY-MM-DD, inclusive), along with their
+    totals. At most `max_days` days at a time.
+    """
+    database_dependency_spec = base.mirror_database_dependency_spec
+    max_days = 366
+
+    validators = dict(
+        date_range=validation.DateRange
+    )
+
+    # Shared by every request, as the cached days never change.
+    _caches = dict()
+
+    def initialize(self, cache_directory='report-cache'):
+        if cache_directory not in self._caches:
+            self._caches[cache_directory] = DayCache(cache_directory)
+        self.cache = self._caches[cache_directory]
+
+    @defer.inlineCallbacks
+    def get(self):
+        spec = self.get_validated_data('date_range', start=self.get_argument('start', None), end=self.get_argument('end', None))
+        if spec['start'] > spec['end']:
+            raise exceptions.BadRequest('start is after end')
+        if (spec['end'] - spec['start']).days >= self.max_days:
+            raise exceptions.BadRequest('at most %i days at a time' % self.max_days)
+
+        self.finish_with_encoded_json((yield self._get_report(spec['start'], spec['end'])))
+
+    @model.with_session
+    def _get_report(self, session, start, end):
+        current_business_date = model.get_business_date(session)
+
+        days = dict()
+        missing = []
+        business_date = start
+        while business_date <= end:
+            day = self.cache.get(business_date) if business_date < current_business_date else None
+            if day is None:
+                missing.append(business_date)
+            elif day['loads'] or day['revenue']:
+                days[business_date] = day
+            business_date += datetime.timedelta(days=1)
+
+        if missing:
+            computed = compute_days(session, missing[0], missing[-1])
+            for business_date in missing:
+                day = computed.get(business_date, _make_day(business_date))
+                if business_date < current_business_date:
+                    # Also cache the days without activity, so we don't ask again.
+                    self.cache.put(business_date, day)
+                if day['loads'] or day['revenue']:
+                    days[business_date] = day
+
+        days = [days[business_date] for business_date in sorted(days)]
+        return self.encode_success(days=days, total=summarize(days))
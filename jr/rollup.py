@@ -0,0 +1,114 @@
+""" Maintains `model.CustomerMonthlyStats` in the Postgres-mirror.
+
+Every invoice and payment that ends up in the archive-tables adds its
+contribution to the month it belongs to, and removes it again when
+it's updated or deleted, so the statistics of a customer never
+require scanning their history.
+"""
+import datetime
+import decimal
+
+import sqlalchemy as sa
+
+from jr import model
+
+
+JUMP_ITEM_TYPE = 1
+PAYMENT_TRANSACTION_TYPE = 1
+
+stats_table = model.CustomerMonthlyStats.__table__
+
+
+def is_rolled_up(table):
+    return table.name in ('tInvAll', 'tPmtAll')
+
+
+def ensure_tables(connection):
+    """ Creates the mirror-only tables, and populates the statistics if
+    this mirror was restored before we had them.
+    """
+    has_stats = stats_table.exists(bind=connection)
+    model.create_mirror_tables(connection)
+    if not has_stats:
+        rebuild(connection)
+
+
+def rebuild(connection):
+    """ Recomputes every statistic from the archive-tables. Used after a
+    complete restore, when applying the changes one by one would be
+    silly.
+    """
+    connection.execute(stats_table.delete())
+    connection.execute(sa.text('''
+        INSERT INTO customer_monthly_stats (customer_id, month, jumps, revenue, payments)
+        SELECT customer_id, month, SUM(jumps), SUM(revenue), SUM(payments) FROM (
+            SELECT i."wCustId" AS customer_id, date_trunc('month', i."dtProcess") AS month,
+                   SUM(CASE WHEN p."nPriceType" = :jump THEN 1 ELSE 0 END) AS jumps,
+                   SUM(COALESCE(i."cPrice", 0)) AS revenue, 0 AS payments
+            FROM "tInvAll" i LEFT JOIN "tPrices" p ON p."wItemId" = i."wItemId"
+            WHERE i."wCustId" IS NOT NULL
+            GROUP BY 1, 2
+
+            UNION ALL
+
+            SELECT "wCustId", date_trunc('month', "dtProcess"), 0, 0, SUM(COALESCE("cAmount", 0))
+            FROM "tPmtAll"
+            WHERE "wCustId" IS NOT NULL AND "nTransType" = :payment
+            GROUP BY 1, 2
+        ) AS stats
+        GROUP BY customer_id, month
+    '''), dict(jump=JUMP_ITEM_TYPE, payment=PAYMENT_TRANSACTION_TYPE))
+
+
+class StatsMaintainer(object):
+    """ Adjusts the statistics as rows are inserted into, or deleted
+    from, the archive-tables.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._item_types = dict()
+
+    def add(self, table, row, sign=1):
+        if row['wCustId'] is None:
+            return
+
+        jumps = revenue = payments = 0
+        if table.name == 'tInvAll':
+            if self._get_item_type(row['wItemId']) == JUMP_ITEM_TYPE:
+                jumps = 1
+            # Rows shipped from JumpRun have their decimals as strings.
+            revenue = decimal.Decimal(row['cPrice'] or 0)
+        elif row['nTransType'] == PAYMENT_TRANSACTION_TYPE:
+            payments = decimal.Decimal(row['cAmount'] or 0)
+
+        if not (jumps or revenue or payments):
+            return
+
+        business_date = row['dtProcess']
+        self._adjust(row['wCustId'], datetime.datetime(business_date.year, business_date.month, 1),
+                     sign * jumps, sign * revenue, sign * payments)
+
+    def remove(self, table, row):
+        self.add(table, row, sign=-1)
+
+    def _adjust(self, customer_id, month, jumps, revenue, payments):
+        c = stats_table.c
+        where_clause = sa.and_(c.customer_id == customer_id, c.month == month)
+
+        result = self.connection.execute(stats_table.update(where_clause).values(
+            jumps=c.jumps + jumps,
+            revenue=c.revenue + revenue,
+            payments=c.payments + payments,
+        ))
+        if not result.rowcount:
+            self.connection.execute(stats_table.insert().values(
+                customer_id=customer_id, month=month, jumps=jumps, revenue=revenue, payments=payments
+            ))
+
+    def _get_item_type(self, item_id):
+        if item_id not in self._item_types:
+            self._item_types[item_id] = self.connection.execute(
+                sa.select([model.Item._item_type]).where(model.Item.item_id == item_id)
+            ).scalar()
+        return self._item_types[item_id]
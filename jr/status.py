@@ -0,0 +1,32 @@
+from jr import base, ids, model, warmup, workers, exceptions
+
+
+class StatusHandler(base.Handler):
+    """ Operational numbers, such as how busy the database worker pools
+    are, how many statements each kind of request executes and how
+    the id allocators are doing. Only for the hosts in the
+    `debug_allow`-setting.
+    """
+    SUPPORTED_METHODS = {"GET", "HEAD"}
+
+    def prepare(self):
+        super(StatusHandler, self).prepare()
+        if self.request.remote_ip not in self.settings.get('debug_allow', list()):
+            raise exceptions.Forbidden('not allowed')
+
+    def get(self):
+        self.succeed_with_json_and_finish(workers=workers.get_stats(), statements=model.statement_stats, ids=ids.get_stats())
+
+
+class ReadyHandler(base.Handler):
+    """ Whether the process has warmed up (see `jr.warmup`): 200 when
+    it's ready for traffic, 503 until then. For load balancers and
+    deploy scripts, so anyone may ask. Served by a site the warm-up
+    doesn't hold back (see `gated_sites` of `jr.processors.WarmUp`).
+    """
+    SUPPORTED_METHODS = {"GET", "HEAD"}
+
+    def get(self):
+        if not warmup.readiness.is_ready:
+            raise exceptions.TemporaryError('warming up', detail=warmup.readiness)
+        self.succeed_with_json_and_finish(readiness=warmup.readiness)
@@ -4,21 +4,38 @@ import time
 
 import sqlalchemy as sa
 from sqlalchemy import orm
-from twisted.internet import defer, threads
+from twisted.internet import defer
 
-from jr import base, model
+from jr import base, cluster, model, workers
+
+
+@model.cached_query
+def _get_customers_query(number_of_customers):
+    return (
+        model.Query(model.Customer).
+        filter(model.Customer.customer_id.in_([sa.bindparam('customer_id_%i' % i) for i in range(number_of_customers)])).
+        order_by(sa.desc(model.Customer.last_jump))
+    )
 
 
 class SuggestHandler(base.Handler):
-    _suffix_array = []
-    _offsets = []
-    _content = None
+    # Names change rarely, and a new jumper is added by rebuilding anyway.
+    read_database_dependency_spec = base.mirror_database_dependency_spec
+
+    # (content, offsets, suffix array), replaced as a whole when rebuilt, as it's searched in other threads.
+    _index = None
+    # Another worker of the cluster has rebuilt its index.
+    _is_stale = False
+    # Requests arriving while the index is built wait for it, instead of building their own.
+    _building = defer.DeferredLock()
 
     @defer.inlineCallbacks
     def get(self):
-        engine = yield self.engine_dependency.wait_for_resource()
-        if not self._content or self.get_argument('rebuild', False):
-            yield threads.deferToThread(self._build_suffix_array, engine)
+        engine = yield self.get_index_engine()
+        if not self._index or self._is_stale or self.get_argument('rebuild', False):
+            if self.get_argument('rebuild', False):
+                cluster.publish('suggest')
+            yield self.build_index(engine, force=self.get_argument('rebuild', False))
 
         query = self.get_argument('q').lower().encode('utf8')
         matches = yield self._find_matching_people(query)
@@ -26,17 +43,36 @@ class SuggestHandler(base.Handler):
         self.succeed_with_json_and_finish(matches=matches)
 
     @classmethod
-    @model.with_session
+    def get_index_engine(cls):
+        if cls.read_engine_dependency.is_ready:
+            return cls.read_engine_dependency.wait_for_resource()
+        return cls.engine_dependency.wait_for_resource()
+
+    @classmethod
+    def build_index(cls, engine, force=False):
+        """ (Re)builds the index in a worker thread, unless it's been
+        built while we waited for our turn.
+        """
+        def build():
+            if cls._index and not cls._is_stale and not force:
+                return
+            SuggestHandler._is_stale = False
+            return workers.get_pool(engine).run(cls._build_suffix_array, engine)
+        return cls._building.run(build)
+
+    @classmethod
+    @model.with_read_only_session
     def _find_matching_people(cls, session, query, n=10):
-        start, end = cls.find_range(query)
+        index = content, offsets, suffix_array = cls._index
+        start, end = cls.find_range(query, index)
 
         matches = set()
         for i in range(start, end + 1):
-            pos = cls._suffix_array[i]
-            start_of_string = cls._offsets[max(0, bisect.bisect_left(cls._offsets, pos) - 1)]
-            end_of_string = cls._offsets[bisect.bisect_right(cls._offsets, pos)] - 1
+            pos = suffix_array[i]
+            start_of_string = offsets[max(0, bisect.bisect_left(offsets, pos) - 1)]
+            end_of_string = offsets[bisect.bisect_right(offsets, pos)] - 1
 
-            matches.add(cls._content[start_of_string:end_of_string])
+            matches.add(content[start_of_string:end_of_string])
 
         if not matches:
             return []
@@ -48,16 +84,15 @@ class SuggestHandler(base.Handler):
         user_ids = [match.split(':')[1] for match in matches]
 
         return (
-            session.query(model.Customer).
-            filter(model.Customer.customer_id.in_(user_ids)).
-            order_by(sa.desc(model.Customer.last_jump)).
+            _get_customers_query(len(user_ids)).with_session(session).
+            params(**dict(('customer_id_%i' % i, user_id) for i, user_id in enumerate(user_ids))).
             all()
         )
 
     @classmethod
     def _build_suffix_array(cls, engine):
         offset = 0
-        cls._offsets = [offset]
+        offsets = [offset]
 
         last_jump_cutoff = datetime.datetime(2006, 1, 1)
 
@@ -68,24 +103,27 @@ class SuggestHandler(base.Handler):
 
             buf.append((u'%s:%s:%s' % (last_jump, r[1] , r[2])).encode('utf8'))
             offset = offset + len(buf[-1]) + 1 # 1 due to delimiter
-            cls._offsets.append(offset)
+            offsets.append(offset)
+
+        content = ';'.join(buf)
+        suffix_array = range(len(content))
 
-        cls._content = ';'.join(buf)
-        cls._suffix_array = range(len(cls._content))
+        lowered_content = content.lower()
+        suffix_array.sort(key=lambda a: buffer(lowered_content, a))
 
-        lowered_content = cls._content.lower()
-        cls._suffix_array.sort(key=lambda a: buffer(lowered_content, a))
+        SuggestHandler._index = content, offsets, suffix_array
 
     @classmethod
-    def find_first_match(cls, query):
+    def find_first_match(cls, query, index):
+        content, offsets, suffix_array = index
         lo = 0
-        hi = len(cls._content)
+        hi = len(content)
         l = len(query)
 
         while lo < hi:
             mid = (lo + hi) // 2
-            pos = cls._suffix_array[mid]
-            if cls._content[pos:pos+l].lower() < query:
+            pos = suffix_array[mid]
+            if content[pos:pos+l].lower() < query:
                 lo = mid + 1
             else:
                 hi = mid
@@ -93,16 +131,17 @@ class SuggestHandler(base.Handler):
         return lo
 
     @classmethod
-    def find_last_match(cls, query):
+    def find_last_match(cls, query, index):
+        content, offsets, suffix_array = index
         lo = 0
-        hi = len(cls._content)
+        hi = len(content)
         l = len(query)
 
         while lo < hi:
             mid = (lo + hi) // 2
-            start = cls._suffix_array[mid]
+            start = suffix_array[mid]
             end = start + l
-            if query < cls._content[start:end].lower():
+            if query < content[start:end].lower():
                 hi = mid
             else:
                 lo = mid+1
@@ -110,5 +149,11 @@ class SuggestHandler(base.Handler):
         return lo - 1
 
     @classmethod
-    def find_range(cls, query):
-        return cls.find_first_match(query), cls.find_last_match(query)
+    def find_range(cls, query, index):
+        return cls.find_first_match(query, index), cls.find_last_match(query, index)
+
+
+def _mark_as_stale(message):
+    SuggestHandler._is_stale = True
+
+cluster.subscribe('suggest', _mark_as_stale)
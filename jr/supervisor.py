@@ -0,0 +1,214 @@
+""" Runs the site in several processes, to use more than one core.
+
+The supervisor binds the listening sockets of the enabled cyclone
+sites of the configuration, and starts `--workers` piped-processes
+with that configuration. The workers inherit the sockets the way
+systemd hands them out --- `LISTEN_FDS` --- and listen on them
+through Twisted's `systemd:`-strports, so the kernel spreads the
+connections among them. Workers that die are restarted.
+
+It also relays the messages of `jr.cluster` between the workers, and
+decides which version the departure board is at, so every worker
+agrees on the ETags and long-polls.
+
+    jr-supervisor -c service.yaml --workers 4
+
+Only plain TCP-ports (`18080` or `tcp:18080:interface=...`) can be
+shared. Note that every worker has its own database connections.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+from piped import conf
+from twisted.internet import defer, protocol, reactor
+
+from jr import cluster
+
+
+logger = logging.getLogger('jr.supervisor')
+
+# Seconds to wait before restarting a worker that died.
+RESTART_DELAY = 1
+# Seconds the workers get to shut down cleanly.
+STOP_TIMEOUT = 10
+
+# What `piped` does, with this interpreter. `sh` makes LISTEN_PID the pid of the worker.
+WORKER_COMMAND = [
+    '/bin/sh', '-c', 'LISTEN_PID=$$ exec "$0" "$@"',
+    sys.executable, '-c', 'import sys; from piped import scripts; sys.argv[0] = "piped"; scripts.run_piped()',
+]
+
+
+def bind(listen):
+    """ Returns a listening socket for the strport `listen`. """
+    parts = str(listen).split(':')
+    if parts[0] == 'tcp':
+        parts = parts[1:]
+    if not parts[0].isdigit():
+        raise ValueError('Only TCP-ports can be shared by the workers, not %r' % listen)
+
+    options = dict(part.split('=', 1) for part in parts[1:])
+    interface = options.get('interface', '')
+    family = socket.AF_INET6 if ':' in interface else socket.AF_INET
+
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((interface, int(parts[0])))
+    sock.listen(int(options.get('backlog', 50)))
+    # Twisted can only adopt non-blocking sockets.
+    sock.setblocking(False)
+    return sock
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.ended = defer.Deferred()
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+        self.supervisor.worker_ended(self, reason)
+
+
+class Supervisor(protocol.DatagramProtocol):
+
+    def __init__(self, configuration_file, number_of_workers, directory, sites, piped_arguments=()):
+        self.configuration_file = configuration_file
+        self.number_of_workers = number_of_workers
+        self.directory = os.path.abspath(directory)
+        # [(site name, socket), ...]
+        self.sites = sites
+        self.piped_arguments = list(piped_arguments)
+
+        self.epoch = int(time.time())
+        self.board_version = 1
+        self.workers = dict()
+        self.stopping = False
+
+    def start(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        address = os.path.join(self.directory, cluster.SUPERVISOR_SOCKET)
+        if os.path.exists(address):
+            os.unlink(address)
+        reactor.listenUNIXDatagram(address, self)
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        for index in range(self.number_of_workers):
+            self.start_worker(index)
+
+    def start_worker(self, index):
+        if self.stopping:
+            return
+
+        arguments = ['-n', '-c', self.configuration_file, '-p', '']
+        for i, (name, sock) in enumerate(self.sites):
+            domain = 'INET6' if sock.family == socket.AF_INET6 else 'INET'
+            arguments += ['-O', 'cyclone.%s.listen:systemd:domain=%s:index=%i' % (name, domain, i)]
+
+        environment = dict(
+            os.environ,
+            LISTEN_FDS=str(len(self.sites)),
+            JR_CLUSTER_DIRECTORY=self.directory,
+            JR_WORKER_INDEX=str(index),
+            JR_WORKERS=str(self.number_of_workers),
+            JR_EPOCH=str(self.epoch),
+        )
+
+        # The inherited sockets must be numbered from 3 and up.
+        child_fds = {0: 0, 1: 1, 2: 2}
+        for i, (name, sock) in enumerate(self.sites):
+            child_fds[3 + i] = sock.fileno()
+
+        worker = WorkerProcess(self, index)
+        reactor.spawnProcess(worker, WORKER_COMMAND[0], WORKER_COMMAND + arguments + self.piped_arguments,
+                             env=environment, childFDs=child_fds)
+        self.workers[index] = worker
+        logger.info('Started worker %i (PID %i)' % (index, worker.transport.pid))
+
+    def worker_ended(self, worker, reason):
+        if self.workers.get(worker.index) is worker:
+            del self.workers[worker.index]
+
+        if not self.stopping:
+            logger.warn('Worker %i ended, restarting it: %s' % (worker.index, reason.getErrorMessage()))
+            reactor.callLater(RESTART_DELAY, self.start_worker, worker.index)
+
+    def stop(self):
+        self.stopping = True
+        for worker in self.workers.values():
+            worker.transport.signalProcess('TERM')
+
+        ended = defer.DeferredList([worker.ended for worker in self.workers.values()])
+        timeout = reactor.callLater(STOP_TIMEOUT, self._kill_workers)
+        ended.addBoth(lambda _: timeout.active() and timeout.cancel())
+        return ended
+
+    def _kill_workers(self):
+        for worker in self.workers.values():
+            logger.warn('Worker %i did not stop in time, killing it' % worker.index)
+            worker.transport.signalProcess('KILL')
+
+    def datagramReceived(self, data, address):
+        message = json.loads(data)
+
+        if message['type'] == 'hello':
+            # A (re)started worker needs to catch up on the board.
+            self.send(message['index'], dict(type='board', version=self.board_version))
+            return
+
+        if message['type'] == 'board':
+            # Concurrent changes in different workers get a version newer than all of them.
+            self.board_version = max(self.board_version + 1, message['version'])
+            data = json.dumps(dict(type='board', version=self.board_version))
+            recipients = range(self.number_of_workers)
+        else:
+            recipients = [index for index in range(self.number_of_workers) if cluster.get_worker_socket(self.directory, index) != address]
+
+        for index in recipients:
+            self.send(index, data)
+
+    def send(self, index, data):
+        if not isinstance(data, basestring):
+            data = json.dumps(data)
+        try:
+            self.transport.write(data, cluster.get_worker_socket(self.directory, index))
+        except socket.error as e:
+            # It's probably being restarted, and will say hello.
+            logger.debug('Could not reach worker %i: %s' % (index, e))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the site in several piped-processes sharing the listening sockets.')
+    parser.add_argument('-c', '--conf', required=True, metavar='config_file.yaml', help='The configuration the workers run.')
+    parser.add_argument('-w', '--workers', type=int, default=multiprocessing.cpu_count(), help='Number of workers. (default: number of cores)')
+    parser.add_argument('-d', '--directory', default='run', help='Where to put the sockets of the workers. (default: "run")')
+    options, piped_arguments = parser.parse_known_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(name)s] %(message)s')
+
+    configuration = conf.ConfigurationManager()
+    configuration.load_from_file(options.conf)
+
+    sites = list()
+    for name, site in sorted(configuration.get('cyclone', dict()).items()):
+        if site.get('enabled', True):
+            sites.append((name, bind(site.get('listen', 8888))))
+            logger.info('Listening on %s for %s' % (sites[-1][1].getsockname(), name))
+
+    supervisor = Supervisor(options.conf, options.workers, options.directory, sites, piped_arguments)
+    reactor.callWhenRunning(supervisor.start)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import datetime
 import decimal
 import formencode
 from formencode import validators
@@ -10,6 +11,26 @@ class Money(validators.Int):
         return decimal.Decimal(value) / decimal.Decimal(100)
 
 
+CURSOR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class Cursor(validators.FancyValidator):
+    """ A position in a listing of archived rows, as returned by
+    `format_cursor`: "<business date>,<id>".
+    """
+
+    def _to_python(self, value, state=None):
+        try:
+            business_date, id = value.split(',')
+            return datetime.datetime.strptime(business_date, CURSOR_DATE_FORMAT), int(id)
+        except ValueError:
+            raise formencode.Invalid('expected "<business date>,<id>"', value, state)
+
+
+def format_cursor(business_date, id):
+    return '%s,%s' % (business_date.strftime(CURSOR_DATE_FORMAT), id)
+
+
 class Spec(formencode.Schema):
     allow_extra_fields = True # Don't error if unknowns are provided
     filter_extra_fields = True # But don't return them either.
@@ -38,8 +59,54 @@ class UpdateItem(Spec):
     price = Money(if_missing=Ellipsis)
 
 
+class DeleteItem(Spec):
+    plane_id = validators.Int()
+    manifest_id = validators.Int()
+    customer_id = validators.Int()
+    item_id = validators.Int(if_missing=None)
+
+
+class Operation(validators.FancyValidator):
+    """ One operation of a `Batch`, validated by the spec of its "op".
+    Returns (op, spec).
+    """
+    specs = dict(
+        add=AddJumper,
+        update=UpdateItem,
+        delete=DeleteItem,
+    )
+
+    def _to_python(self, value, state=None):
+        if not isinstance(value, dict) or value.get('op') not in self.specs:
+            raise formencode.Invalid('expected an object with "op" being one of %s' % ', '.join(sorted(self.specs)), value, state)
+        return value['op'], self.specs[value['op']].to_python(value, state)
+
+
+class Batch(Spec):
+    operations = formencode.ForEach(Operation(), not_empty=True)
+
+
 class UpdateManifest(Spec):
     plane_id = validators.Int()
     manifest_id = validators.Int()
     # departure. anything else..?
 
+
+class Page(Spec):
+    before = Cursor(if_missing=None)
+    limit = validators.Int(min=1, if_missing=None)
+
+
+class Date(validators.FancyValidator):
+    """ A date as YYYY-MM-DD. """
+
+    def _to_python(self, value, state=None):
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            raise formencode.Invalid('expected YYYY-MM-DD', value, state)
+
+
+class DateRange(Spec):
+    start = Date(not_empty=True)
+    end = Date(not_empty=True)
@@ -0,0 +1,83 @@
+""" Getting a process ready before it gets traffic.
+
+Left alone, the first requests after a (re)start pay for everything
+that's built lazily: configuring the mappers and compiling the JSON-
+serializers and the cached queries, connecting to the databases,
+loading `reference.data` and building the suggest-index. The
+`warm-up`-processor (see `jr.processors.WarmUp`), run at startup,
+does all of that up front, and `jr.status.ReadyHandler` answers 503
+until it's done, for load balancers and deploy scripts to wait for.
+
+The sites that need the warm-up don't accept connections until it's
+done, either. That matters in a cluster (see `jr.supervisor`): the
+workers share the listening sockets, so the warm workers get all the
+API-traffic while a (re)started one warms up. The public site and the
+status site (with `/ready`) are never held back, so they stay up even
+if JumpRun can't be reached.
+"""
+import logging
+import time
+
+from twisted.internet import reactor, tcp
+
+
+logger = logging.getLogger('jr')
+
+
+class Readiness(object):
+
+    def __init__(self):
+        self.is_ready = False
+        self.started_at = None
+        # Seconds per step done, in the order they were done.
+        self.steps = []
+        self.current_step = None
+        self.error = None
+
+    def start(self):
+        self.started_at = time.time()
+        self.steps = []
+        self.error = None
+
+    def step(self, name):
+        """ Marks the start of step `name`, and the end of the previous. """
+        now = time.time()
+        if self.current_step:
+            self.steps.append((self.current_step, now - self._step_started_at))
+        self.current_step = name
+        self._step_started_at = now
+
+    def ready(self):
+        self.step(None)
+        self.is_ready = True
+        logger.info('Warmed up in %.2fs: %s' % (
+            time.time() - self.started_at, ', '.join('%s %.2fs' % step for step in self.steps)
+        ))
+
+    def failed(self, reason):
+        self.error = '%s: %s' % (self.current_step, reason)
+        self.current_step = None
+        logger.error('Warming up failed during %s' % self.error)
+
+    def __json__(self):
+        return dict(ready=self.is_ready, current_step=self.current_step, error=self.error,
+                    steps=[dict(name=name, seconds=seconds) for name, seconds in self.steps])
+
+
+readiness = Readiness()
+
+
+def stop_accepting(applications):
+    """ Stops accepting connections on the listening TCP-ports of
+    `applications`, and returns the ports. Connections wait in the
+    backlog meanwhile, for whoever accepts them.
+    """
+    ports = [reader for reader in reactor.getReaders() if isinstance(reader, tcp.Port) and reader.factory in applications]
+    for port in ports:
+        port.stopReading()
+    return ports
+
+
+def start_accepting(ports):
+    for port in ports:
+        port.startReading()
@@ -0,0 +1,110 @@
+import logging
+import threading
+import time
+
+from twisted.internet import defer, reactor, threads
+from twisted.python import threadpool
+
+from jr import exceptions
+
+
+logger = logging.getLogger('jr')
+
+# Without a QueuePool (e.g. SQLite), there's nothing to size the pool by.
+DEFAULT_SIZE = 4
+# How many calls may wait for a thread, per thread, before we turn clients away.
+QUEUED_PER_THREAD = 8
+
+
+class WorkerPool(object):
+    """ Runs database-work for an engine in a dedicated thread pool,
+    with as many threads as the engine has connections.
+
+    Threads that would only be waiting for a connection anyway are
+    pointless, and when everything is busy, the calls queue up here
+    --- where we can see it --- instead of in the reactor's thread
+    pool, which is shared with everything else. When `max_queued`
+    calls are already waiting, `run` fails fast with a
+    `TemporaryError`, so the client gets a 503 rather than a response
+    long after it has given up.
+    """
+
+    def __init__(self, name, size, max_queued):
+        self.name = name
+        self.size = size
+        self.max_queued = max_queued
+
+        self.running = 0
+        self.queued = 0
+        self.max_queued_seen = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait_time = 0
+        self.max_wait_time = 0
+        # The counters are updated from both the reactor and the workers.
+        self._lock = threading.Lock()
+
+        self._pool = threadpool.ThreadPool(minthreads=0, maxthreads=size, name='jr-db-%s' % name)
+        self._pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self._pool.stop)
+
+    def run(self, f, *args, **kwargs):
+        """ Returns a deferred that fires with the result of calling
+        `f` in one of the pool's threads.
+        """
+        with self._lock:
+            if self.queued >= self.max_queued:
+                self.rejected += 1
+                logger.warn('Database worker pool "%s" is saturated: %i running, %i queued' % (self.name, self.running, self.queued))
+                return defer.fail(exceptions.TemporaryError('too busy, please try again'))
+
+            self.queued += 1
+            self.max_queued_seen = max(self.max_queued_seen, self.queued)
+
+        return threads.deferToThreadPool(reactor, self._pool, self._run, time.time(), f, args, kwargs)
+
+    def _run(self, queued_at, f, args, kwargs):
+        wait_time = time.time() - queued_at
+        with self._lock:
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            self.queued -= 1
+            self.running += 1
+        try:
+            return f(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+
+    def get_stats(self):
+        return dict(
+            size=self.size,
+            running=self.running,
+            queued=self.queued,
+            max_queued=self.max_queued,
+            max_queued_seen=self.max_queued_seen,
+            completed=self.completed,
+            rejected=self.rejected,
+            average_wait_time=self.total_wait_time / self.completed if self.completed else 0,
+            max_wait_time=self.max_wait_time,
+        )
+
+
+pools = dict()
+
+
+def get_pool(engine):
+    """ Returns the worker pool for `engine`, creating it as needed. """
+    if engine not in pools:
+        # Sized like the connection pool, i.e. pool_size + max_overflow.
+        size = DEFAULT_SIZE
+        if hasattr(engine.pool, 'size') and hasattr(engine.pool, '_max_overflow'):
+            size = engine.pool.size() + max(engine.pool._max_overflow, 0)
+
+        pools[engine] = WorkerPool(engine.url.database or engine.url.host or str(engine.url), size, size * QUEUED_PER_THREAD)
+    return pools[engine]
+
+
+def get_stats():
+    return dict((pool.name, pool.get_stats()) for pool in pools.values())
@@ -1,11 +1,15 @@
 define(function (require) {
     var Backbone = require('backbone'),
         _ = require('underscore'),
+        $ = require('jquery'),
         Plane = require('models/plane'),
         settings = require('settings');
 
     return Backbone.Collection.extend({
 
+        // The version of the board we have. Used to wait for changes.
+        version: null,
+
         model: function(attrs, options) {
             return Plane.create(attrs, options);
         },
@@ -15,7 +19,25 @@ define(function (require) {
         },
 
         parse: function(response) {
+            this.version = response.version;
             return response.planes;
+        },
+
+        // Waits for the board to change, then resets the collection.
+        waitForChanges: function() {
+            var self = this;
+
+            return $.ajax({
+                url: self.url() + '/changes',
+                data: { since: self.version },
+                dataType: 'json'
+            }).then(function(response) {
+                if (response.planes) {
+                    self.reset(self.parse(response));
+                } else {
+                    self.version = response.version;
+                }
+            });
         }
     });
 
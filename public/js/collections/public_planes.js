@@ -0,0 +1,61 @@
+define(function (require) {
+    var _ = require('underscore'),
+        $ = require('jquery'),
+        Planes = require('./planes'),
+        settings = require('settings');
+
+    // The departure board of the public site, which is published as
+    // static files: a pointer to the current version, which we poll,
+    // and the versions themselves, which never change.
+    return Planes.extend({
+
+        pollInterval: 2000,
+
+        url: function(models) {
+            return settings.publicBoardUrl + '/' + this.filename;
+        },
+
+        pointerUrl: function() {
+            return settings.publicBoardUrl + '/current.json';
+        },
+
+        getPointer: function() {
+            // The browser caches it for as long as the server says.
+            return $.ajax({
+                url: this.pointerUrl(),
+                dataType: 'json'
+            });
+        },
+
+        fetch: function(options) {
+            var self = this;
+
+            return self.getPointer().then(function(pointer) {
+                self.filename = pointer.filename;
+                return Planes.prototype.fetch.call(self, options);
+            });
+        },
+
+        // Polls the pointer until it points to another version, then resets the collection.
+        waitForChanges: function() {
+            var self = this,
+                deferred = $.Deferred();
+
+            function poll() {
+                self.getPointer().then(function(pointer) {
+                    if (pointer.version === self.version) {
+                        _.delay(poll, self.pollInterval);
+                        return;
+                    }
+
+                    self.filename = pointer.filename;
+                    Planes.prototype.fetch.call(self).then(deferred.resolve, deferred.reject);
+                }, deferred.reject);
+            }
+
+            poll();
+            return deferred.promise();
+        }
+    });
+
+});
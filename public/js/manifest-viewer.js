@@ -1,6 +1,6 @@
 define(function(require) {
     require('initializers/models');
-    var Planes = require('collections/planes'),
+    var Planes = require('collections/public_planes'),
         ManifestPlanesView = require('views/manifest/planes'),
         $ = require('jquery');
 
@@ -14,12 +14,16 @@ define(function(require) {
         var foo = window.view.render();
         var el = $('#planes').html(window.view.el);
     }).then(function() {
+            // Resolves when a new version of the board has been published.
             function keepUpdating() {
-                window.planes.fetch().then(function() {
-                    _.delay(keepUpdating, 1000);
+                window.planes.waitForChanges().then(function() {
+                    keepUpdating();
+                }, function() {
+                    // Server restarting or the Wi-Fi acting up. Back off a bit.
+                    _.delay(keepUpdating, 5000);
                 });
             };
 
-            _.delay(keepUpdating, 1000);
+            keepUpdating();
     });
-});
\ No newline at end of file
+});
@@ -13,6 +13,22 @@ define(function (require) {
 
             isOwingMoney: function() {
                 return this.get('balance') > 0;
+            },
+
+            // 'owing', 'soon-owing' or null. The public board has no
+            // balances, so there it's already been decided for us.
+            getStanding: function(item) {
+                if (this.has('standing')) {
+                    return this.get('standing');
+                }
+                if (this.isOwingMoney()) {
+                    return 'owing';
+                }
+                if (-1 * this.get('balance') < item.get('price')) {
+                    // Can only afford one more jump, so will soon be owing money.
+                    return 'soon-owing';
+                }
+                return null;
             }
         });
 
@@ -1,6 +1,8 @@
 define(function() {
     var settings = {
-        apiUrl: '/api/v0'
+        apiUrl: '/api/v0',
+        // Where the public site publishes the departure board.
+        publicBoardUrl: '/board'
     };
 
     return settings;
@@ -18,11 +18,9 @@ define(function(require) {
                     $el = self.$el,
                     model = self.model;
 
-                if(model.customer().isOwingMoney()) {
-                    $el.addClass('owing');
-                } else if (-1 * model.customer().get('balance') < model.item().get('price')) {
-                    // Can only afford one more jump, so will soon be owing money.
-                    $el.addClass('soon-owing');
+                var standing = model.customer().getStanding(model.item());
+                if (standing) {
+                    $el.addClass(standing);
                 }
             },
 
@@ -13,6 +13,11 @@ setup(
     zip_safe=False,
 
     entry_points = dict(
+        console_scripts = [
+            'jr-supervisor = jr.supervisor:main',
+            'jr-build-assets = jr.assets:main',
+            'jr-mirror-schema = jr.mirror:main',
+        ],
     ),
 
     install_requires = [